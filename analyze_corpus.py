@@ -0,0 +1,159 @@
+import argparse
+import io
+import mmap
+import os
+from multiprocessing import Pool
+
+import chess.pgn
+import numpy as np
+import torch
+
+from lib.mimic import MimicBotCore, length_buckets, tokenize_game
+
+parser = argparse.ArgumentParser(
+    description="Per-ply elo analysis of every game in a PGN file",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("pgn", help="PGN file containing any number of games")
+parser.add_argument(
+    "--output", help="npz file for the columnar results", default="elo_analysis.npz")
+parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="processes used for PGN parsing and tokenization")
+parser.add_argument("--shard_size", type=int, default=256,
+                    help="games handed to a worker at a time")
+parser.add_argument("--chunk_size", type=int, default=8192,
+                    help="tokenized games gathered before running inference")
+parser.add_argument("--batch_size", type=int, default=64,
+                    help="max games per forward pass")
+parser.add_argument("--bucket_width", type=int, default=16,
+                    help="only batch games whose lengths fall in the same range")
+parser.add_argument("--threads", type=int, default=None,
+                    help="torch threads used for inference")
+
+# status codes stored per game
+OK = 0
+UNREADABLE = 1
+TOO_LONG = 2
+
+pgn_map = None
+
+
+def open_pgn(fn):
+    global pgn_map
+    with open(fn, "rb") as f:
+        pgn_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def game_offsets(mm):
+    """Byte offsets of every game in a memory-mapped PGN file."""
+    # the first game may follow a BOM, blank lines or a comment
+    first = mm.find(b"[Event ")
+    if first == -1:
+        return []
+    offsets = [first]
+    pos = mm.find(b"\n[Event ", first)
+    while pos != -1:
+        offsets.append(pos + 1)
+        pos = mm.find(b"\n[Event ", pos + 1)
+    return offsets
+
+
+def tokenize_shard(shard):
+    """Parse and tokenize the games between consecutive offsets of a shard."""
+    games = []
+    for start, end in shard:
+        text = pgn_map[start:end].decode("utf-8", errors="replace")
+        try:
+            game = chess.pgn.read_game(io.StringIO(text))
+            if game is None or "FEN" in game.headers:
+                games.append((start, None))
+            else:
+                _, inp = tokenize_game(game)
+                games.append((start, inp[0].numpy().astype(np.int16)))
+        except Exception:
+            games.append((start, None))
+    return games
+
+
+def analyze_chunk(core, chunk, batch_size, bucket_width):
+    """Run elo-only inference over a chunk of tokenized games."""
+    results = {}
+    for batch in length_buckets(chunk, lambda g: len(g[1]), batch_size, bucket_width):
+        lengths = [len(mvids) for _, mvids in batch]
+        tokens = torch.zeros((len(batch), max(lengths)), dtype=torch.int32)
+        for j, (_, mvids) in enumerate(batch):
+            tokens[j, : lengths[j]] = torch.from_numpy(mvids.astype(np.int32))
+        _, elo_preds = core.model(tokens, elo_head=core.elo_head, elo_only=True)
+        for j, (offset, _) in enumerate(batch):
+            ms, ss = core.create_elo_analysis(elo_preds[j : j + 1, : lengths[j]])
+            results[offset] = (ms.float().numpy(), ss.float().numpy())
+    return results
+
+
+def main():
+    args = parser.parse_args()
+
+    open_pgn(args.pgn)
+    offsets = game_offsets(pgn_map)
+    bounds = list(zip(offsets, offsets[1:] + [len(pgn_map)]))
+    shards = [bounds[i : i + args.shard_size]
+              for i in range(0, len(bounds), args.shard_size)]
+    print(f"{len(offsets)} games in {len(shards)} shards")
+
+    # fork the workers before torch starts its thread pools
+    pool = Pool(args.workers, initializer=open_pgn, initargs=(args.pgn,))
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    core = MimicBotCore()
+    max_len = 2 * core.model_args.max_seq_len
+
+    status = {}
+    analysis = {}
+    chunk = []
+    for games in pool.imap(tokenize_shard, shards):
+        for offset, mvids in games:
+            if mvids is None:
+                status[offset] = UNREADABLE
+            elif len(mvids) > max_len:
+                status[offset] = TOO_LONG
+            else:
+                status[offset] = OK
+                chunk.append((offset, mvids))
+        if len(chunk) >= args.chunk_size:
+            analysis.update(analyze_chunk(
+                core, chunk, args.batch_size, args.bucket_width))
+            print(f"analyzed {len(analysis)} of {len(offsets)} games")
+            chunk = []
+    if chunk:
+        analysis.update(analyze_chunk(
+            core, chunk, args.batch_size, args.bucket_width))
+    pool.close()
+    pool.join()
+
+    # per-ply rows of every game, in file order; rows alternate white/black
+    # exactly as returned by MimicBotCore.create_elo_analysis
+    ply_offsets = [0]
+    means = []
+    variances = []
+    for offset in offsets:
+        if offset in analysis:
+            ms, ss = analysis[offset]
+            means.append(ms)
+            variances.append(ss)
+            ply_offsets.append(ply_offsets[-1] + len(ms))
+        else:
+            ply_offsets.append(ply_offsets[-1])
+
+    empty = np.zeros(0, dtype=np.float32)
+    np.savez(
+        args.output,
+        pgn_offsets=np.array(offsets, dtype=np.int64),
+        status=np.array([status[offset] for offset in offsets], dtype=np.int8),
+        ply_offsets=np.array(ply_offsets, dtype=np.int64),
+        elo_mean=np.concatenate(means) if means else empty,
+        elo_var=np.concatenate(variances) if variances else empty,
+    )
+    print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import os
+import pathlib
+from collections import Counter
+
+import chess
+import chess.pgn
+import torch
+
+from lib.mimic import MimicBotCore, length_buckets
+from lib.models.latest import MODEL_ID
+from lib.opening_table import write_table
+from lib.pgnutils import STARTMV, BoardState
+
+parser = argparse.ArgumentParser(
+    description="Precompute the bot's predictions for the most common openings of a PGN corpus",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("pgn", help="PGN file containing any number of games")
+parser.add_argument(
+    "--output",
+    default=os.path.join(pathlib.Path(__file__).parent.resolve(),
+                         "lib", "models", "latest", "opening_table.bin"),
+    help="table file; workers load <model dir>/opening_table.bin by default")
+parser.add_argument("--num_prefixes", type=int, default=100000,
+                    help="number of most frequent opening prefixes to store")
+parser.add_argument("--max_depth", type=int, default=12,
+                    help="longest prefix, in plies")
+parser.add_argument("--max_games", type=int, default=None,
+                    help="only read this many games from the PGN")
+parser.add_argument("--batch_size", type=int, default=64,
+                    help="max prefixes per forward pass")
+
+
+def count_prefixes(fn, max_depth, max_games):
+    """How often each sequence of opening moves occurs, up to `max_depth` plies."""
+    counts = Counter()
+    games = 0
+    with open(fn) as f:
+        while max_games is None or games < max_games:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                break
+            if "FEN" in game.headers:
+                continue
+            games += 1
+            moves = [move.uci() for _, move in zip(range(max_depth), game.mainline_moves())]
+            for n in range(len(moves) + 1):
+                counts[tuple(moves[:n])] += 1
+    return counts, games
+
+
+def replay(core, moves):
+    """The tokens of a prefix and the vocabulary ids of its legal replies."""
+    state = BoardState()
+    board = chess.Board()
+    tokens = [STARTMV]
+    for uci in moves:
+        mvid = state.uci_to_mvid(uci)
+        state.update(mvid)
+        board.push_uci(uci)
+        tokens.append(mvid)
+    return tokens, core._legal_mvids(state, board)
+
+
+def main():
+    args = parser.parse_args()
+    counts, games = count_prefixes(args.pgn, args.max_depth, args.max_games)
+    prefixes = [moves for moves, _ in counts.most_common(args.num_prefixes)]
+    print(f"{len(counts)} distinct prefixes in {games} games; keeping {len(prefixes)}")
+
+    core = MimicBotCore()
+    items = []
+    for moves in prefixes:
+        tokens, legal = replay(core, moves)
+        if len(legal) > 0:
+            items.append((moves, tokens, legal))
+
+    entries = {}
+    for batch in length_buckets(items, lambda item: len(item[1]), args.batch_size, 1):
+        length = len(batch[0][1])
+        tokens = torch.tensor([tokens for _, tokens, _ in batch], dtype=torch.int32)
+        mv_pred, elo_pred = core.model(
+            tokens, move_head=(*core.move_head, None), elo_head=core.elo_head)
+        # the same outputs MimicBotCore.predict samples from
+        color = length % 2
+        for j, (moves, prefix, legal) in enumerate(batch):
+            uci = moves[-1] if moves else None
+            entries[tuple(prefix)] = core._prediction(
+                uci, tokens[j : j + 1], mv_pred[j, -1, color, legal], legal,
+                elo_pred[j : j + 1, -core.last_n :])
+        print(f"computed {len(entries)} of {len(items)} predictions")
+
+    write_table(args.output, MODEL_ID, core.top_n, entries)
+    print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
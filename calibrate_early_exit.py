@@ -0,0 +1,147 @@
+import argparse
+import os
+
+import torch
+
+from export_onnx import MODELS_DIR, load_transformer
+from lib.engines import Wrapper
+from lib.kvcache import KVCache
+from lib.mimic import tokenize_game
+from lib.models import get_config
+from quantize_eval import read_games
+
+MODEL_IDS = ["dual_zero_v04", "dual_1b", "black_and_white_v1_175k"]
+DEFAULT_THRESHOLDS = {
+    "top1": [0.5, 0.7, 0.8, 0.9, 0.95, 0.99],
+    "entropy": [2.0, 1.0, 0.5, 0.25, 0.1],
+}
+
+parser = argparse.ArgumentParser(
+    description="Report the move agreement and the layers saved by early exit "
+    "at a range of confidence thresholds, for every model under lib/models, "
+    "first per position and then replaying the games through the KV cache",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("pgn", help="PGN file with sample games")
+parser.add_argument("--model_ids", nargs="+", default=MODEL_IDS)
+parser.add_argument("--num_games", type=int, default=100,
+                    help="number of games read from the PGN")
+parser.add_argument("--layers", type=int, nargs="+", default=None,
+                    help="candidate exit layers; defaults to every other layer")
+parser.add_argument("--criterion", choices=list(DEFAULT_THRESHOLDS), default="top1",
+                    help="exit on a minimum top-1 probability or a maximum entropy")
+parser.add_argument("--thresholds", type=float, nargs="+", default=None)
+
+
+def move_logprobs(model, inp, depth):
+    """Move log-probabilities of the player to move at every position, after `depth` layers."""
+    # without thresholds, every forward exits at the only layer given
+    early_exit = ((depth,), None, None) if depth < model.model.n_layers else None
+    mv_pred, _ = model(inp, move_head=(-1, -1, None), elo_head=0,
+                       early_exit=early_exit)
+    # the color that plays after each position, as in MimicBotCore.predict
+    colors = (torch.arange(inp.shape[1]) + 1) % 2
+    logits = mv_pred[0, torch.arange(inp.shape[1]), colors]
+    return logits.log_softmax(dim=-1)
+
+
+def replay(model, model_args, inp, early_exit):
+    """
+    Feed a game through a KV cache one position at a time, as play does, and
+    get the move log-probabilities and elo means at every position and the
+    layers run for each token fed, including tokens fed again.
+    """
+    cache = KVCache(model_args)
+    logps, elos, depths = [], [], []
+    for end in range(1, inp.shape[1] + 1):
+        # a call that exited early left its tokens to be fed again
+        start = cache.seqlen
+        mv_pred, elo_pred = model(inp[:, start:end], start, cache,
+                                  move_head=(-1, -1, end % 2), elo_head=0,
+                                  last_n=1, early_exit=early_exit)
+        logps.append(mv_pred[0, -1].log_softmax(dim=-1))
+        elos.append(elo_pred[0, -1, 0, 0])
+        depths.append((end - start) * model.model.exit_depth)
+    return torch.stack(logps), torch.stack(elos), depths
+
+
+def calibrate(model_id, games, layers, criterion, thresholds):
+    transformer, model_args = load_transformer(model_id, None)
+    model = Wrapper(transformer)
+    n_layers = model_args.n_layers
+    layers = sorted(layer for layer in layers or range(2, n_layers, 2)
+                    if 0 < layer < n_layers)
+    max_len = 2 * model_args.max_seq_len
+
+    # (positions, candidate layers + final layer) of log-probabilities
+    depth_logps = []
+    inps = []
+    for game in games:
+        _, inp = tokenize_game(game)
+        inp = inp[:, :max_len]
+        inps.append(inp)
+        depth_logps.append(torch.stack(
+            [move_logprobs(model, inp, depth) for depth in layers + [n_layers]],
+            dim=1))
+    logps = torch.cat(depth_logps)
+    probs = logps.exp()
+    if criterion == "top1":
+        confident = probs.max(dim=-1).values[:, :-1, None] >= torch.tensor(thresholds)
+    else:
+        entropy = torch.special.entr(probs).sum(dim=-1)
+        confident = entropy[:, :-1, None] <= torch.tensor(thresholds)
+    # the first confident candidate layer, or the final layer
+    confident = torch.cat(
+        [confident, torch.ones_like(confident[:, :1])], dim=1)
+    exits = confident.int().argmax(dim=1)
+    depths = torch.tensor(layers + [n_layers])[exits]
+
+    reference = logps[:, -1]
+    print(f"{model_id}: {len(games)} games, {len(logps)} positions, "
+          f"{n_layers} layers, candidates {layers}")
+    print(f"  {criterion:>9}  agreement  mean KL    mean layers  layers saved")
+    for i, threshold in enumerate(thresholds):
+        exited = logps[torch.arange(len(logps)), exits[:, i]]
+        agree = exited.argmax(dim=-1) == reference.argmax(dim=-1)
+        kl = (reference.exp() * (reference - exited)).sum(dim=-1)
+        depth = depths[:, i].float().mean()
+        print(f"  {threshold:>9.3f}  {100 * agree.float().mean():>8.2f}%  "
+              f"{kl.mean():.5f}  {depth:>11.2f}  {100 * (1 - depth / n_layers):>11.1f}%")
+
+    # the keys/values of exited positions are recomputed by later calls, so
+    # replay the games to measure what play sees, elo estimates included
+    _, whiten_std = get_config(
+        os.path.join(MODELS_DIR, model_id, "cfg.yml")).elo_params.whiten_params
+    full_elos = torch.cat(
+        [model(inp, move_head=(-1, -1, None), elo_head=0)[1][0, :, 0, 0]
+         for inp in inps])
+    print("  replayed through the KV cache")
+    print(f"  {criterion:>9}  agreement  mean KL    mean layers  layers saved  "
+          "mean |elo delta|")
+    for threshold in thresholds:
+        if criterion == "top1":
+            early_exit = (tuple(layers), threshold, None)
+        else:
+            early_exit = (tuple(layers), None, threshold)
+        replays = [replay(model, model_args, inp, early_exit) for inp in inps]
+        exited = torch.cat([logps for logps, _, _ in replays])
+        elos = torch.cat([elos for _, elos, _ in replays])
+        depth = sum(sum(depths) for _, _, depths in replays) / len(exited)
+        agree = exited.argmax(dim=-1) == reference.argmax(dim=-1)
+        kl = (reference.exp() * (reference - exited)).sum(dim=-1)
+        elo_delta = (elos - full_elos).abs().mean() * whiten_std
+        print(f"  {threshold:>9.3f}  {100 * agree.float().mean():>8.2f}%  "
+              f"{kl.mean():.5f}  {depth:>11.2f}  {100 * (1 - depth / n_layers):>11.1f}%  "
+              f"{elo_delta:>16.1f}")
+
+
+def main():
+    args = parser.parse_args()
+    games = read_games(args.pgn, args.num_games)
+    thresholds = args.thresholds or DEFAULT_THRESHOLDS[args.criterion]
+    with torch.inference_mode():
+        for model_id in args.model_ids:
+            calibrate(model_id, games, args.layers, args.criterion, thresholds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import copy
+import importlib
+
+import torch
+from torch.nn.attention import SDPBackend, sdpa_kernel
+
+from lib.kvcache import KVCache
+from lib.prefix_cache import PrefixKVCache
+
+MODEL_IDS = ["dual_zero_v04", "dual_1b", "black_and_white_v1_175k"]
+
+parser = argparse.ArgumentParser(
+    description="Check the fused attention and weight fusion of every model definition "
+    "against the reference math kernel, incremental decoding, the unfused weights and "
+    "a replay from the prefix cache, with small random weights",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--seqlen", type=int, default=40)
+parser.add_argument("--atol", type=float, default=1e-4)
+
+SMALL_ARGS = {
+    "dim": 128,
+    "n_layers": 2,
+    "n_heads": 8,
+    "n_kv_heads": 2,
+    "vocab_size": 2048,
+    "predict_move": True,
+    "elo_pred_size": 2,
+    "gaussian_elo": True,
+    "n_elo_heads": 2,
+    "n_timecontrol_heads": 2,
+    "multiple_of": 64,
+    "ffn_dim_multiplier": None,
+    "norm_eps": 1e-5,
+    "rope_theta": 500000,
+    "max_seq_len": 64,
+}
+
+
+def max_diff(a, b):
+    return max((x - y).abs().max().item() for x, y in zip(a, b))
+
+
+def check(model_id, seqlen):
+    module = importlib.import_module(f"lib.models.{model_id}.model")
+    args = module.ModelArgs(dict(SMALL_ARGS))
+    model = module.Transformer(args).eval()
+    tokens = torch.randint(0, args.vocab_size, (1, seqlen))
+
+    with torch.inference_mode():
+        fused = model(tokens)
+        with sdpa_kernel(SDPBackend.MATH):
+            reference = model(tokens)
+
+        # a prefix in one pass, then one token at a time
+        split = seqlen // 2
+        cache = KVCache(args)
+        steps = [model(tokens[:, :split], 0, cache)]
+        for pos in range(split, seqlen):
+            steps.append(model(tokens[:, pos:pos + 1], pos, cache))
+        incremental = [torch.cat(outs, dim=1) for outs in zip(*steps)]
+
+        fused_model = copy.deepcopy(model)
+        fused_model.fuse_weights()
+        fused_weights = fused_model(tokens)
+        play_head = (-1, -1, None)
+        play = model(tokens, move_head=play_head, elo_head=0)
+        fused_play = fused_model(tokens, move_head=play_head, elo_head=0)
+
+        # a game whose blocks another game already cached, fed as in
+        # MimicBotCore.predict; the length makes every block but the last
+        # token's a full one, so each of the last two positions must still
+        # be run to get its elo outputs
+        prefix_cache = PrefixKVCache(block_size=4)
+        n = (seqlen - 1) // 4 * 4 + 1
+        cache = KVCache(args)
+        model(tokens[:, :n], 0, cache)
+        prefix_cache.insert(cache, tokens[:, :n])
+        cache = KVCache(args)
+        prefix_cache.extend(cache, tokens[:, :n], keep=2)
+        start = cache.seqlen
+        _, replay_elo = model(tokens[:, start:n], start, cache,
+                              move_head=play_head, elo_head=0, last_n=2)
+        _, uncached_elo = model(tokens[:, :n], move_head=play_head,
+                                elo_head=0, last_n=2)
+        assert replay_elo.shape == uncached_elo.shape, "replay lost an elo position"
+
+    return (
+        max_diff(fused, reference),
+        max_diff(fused, incremental),
+        max(max_diff(fused, fused_weights), max_diff(play, fused_play)),
+        max_diff([replay_elo], [uncached_elo]),
+    )
+
+
+def main():
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    ok = True
+    for model_id in MODEL_IDS:
+        diffs = check(model_id, args.seqlen)
+        ok &= max(diffs) < args.atol
+        print(f"{model_id}: max abs difference vs math kernel {diffs[0]:.2e}, "
+              f"vs cached decoding {diffs[1]:.2e}, vs fused weights {diffs[2]:.2e}, "
+              f"vs prefix cache replay {diffs[3]:.2e}")
+    print("ok" if ok else f"FAILED (atol {args.atol})")
+
+
+if __name__ == "__main__":
+    main()
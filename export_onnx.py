@@ -0,0 +1,109 @@
+import argparse
+import importlib
+import os
+import pathlib
+import time
+
+import torch
+
+from lib.engines import OnnxEngine, Wrapper
+from lib.mimic import get_model_args
+from lib.models import get_config
+from lib.models.latest import MODEL_ID
+from lib.pgnutils import STARTMV
+
+MODELS_DIR = os.path.join(pathlib.Path(__file__).parent.resolve(), "lib", "models")
+
+parser = argparse.ArgumentParser(
+    description="Export a model under lib/models to ONNX for the onnx inference backend",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--model_id", default=MODEL_ID,
+                    help="model directory under lib/models")
+parser.add_argument("--weights", default=None,
+                    help="checkpoint to export; defaults to <model dir>/weights.ckpt")
+parser.add_argument("--output", default=None,
+                    help="onnx file; defaults to <model dir>/model.onnx")
+parser.add_argument("--opset", type=int, default=17)
+parser.add_argument("--check_len", type=int, default=64,
+                    help="sequence length used to compare the export against pytorch; 0 skips the check")
+
+
+class ExportModule(torch.nn.Module):
+    """Every move and elo head of a Transformer, over a full token sequence."""
+
+    def __init__(self, transformer):
+        super().__init__()
+        self.model = transformer
+
+    def forward(self, tokens):
+        return self.model(tokens)
+
+
+def load_transformer(model_id, weights):
+    model_dir = os.path.join(MODELS_DIR, model_id)
+    module = importlib.import_module(f"lib.models.{model_id}.model")
+    model_args = get_model_args(get_config(os.path.join(model_dir, "cfg.yml")))
+    transformer = module.Transformer(model_args)
+    cp = torch.load(
+        weights or os.path.join(model_dir, "weights.ckpt"),
+        map_location=torch.device("cpu"),
+        weights_only=True,
+    )
+    # checkpoints are saved from the Wrapper used at inference time
+    Wrapper(transformer).load_state_dict(cp)
+    return transformer.eval(), model_args
+
+
+def check(transformer, output, length):
+    """Compare the outputs and speed of onnxruntime and eager pytorch."""
+    tokens = torch.randint(0, transformer.vocab_size, (1, length), dtype=torch.int32)
+    tokens[0, 0] = STARTMV
+    engine = OnnxEngine(output)
+    reference = Wrapper(transformer)
+    timings = {}
+    outputs = {}
+    for name, model in [("pytorch", reference), ("onnxruntime", engine)]:
+        model(tokens)
+        start = time.perf_counter()
+        outputs[name] = model(tokens)
+        timings[name] = time.perf_counter() - start
+    for i, name in enumerate(["mv_pred", "elo_pred"]):
+        diff = (outputs["pytorch"][i] - outputs["onnxruntime"][i]).abs().max()
+        print(f"{name} max abs difference: {diff:.2e}")
+    for name, t in timings.items():
+        print(f"{name} forward time ({length} tokens): {1000 * t:.1f}ms")
+
+
+def main():
+    args = parser.parse_args()
+    transformer, model_args = load_transformer(args.model_id, args.weights)
+    # onnx has no complex tensors, so the rotary embedding runs on the real
+    # and imaginary parts instead
+    transformer.freqs_cis = torch.view_as_real(transformer.freqs_cis).contiguous()
+
+    output = args.output or os.path.join(MODELS_DIR, args.model_id, "model.onnx")
+    tokens = torch.full((1, 8), STARTMV, dtype=torch.int64)
+    with torch.inference_mode():
+        torch.onnx.export(
+            ExportModule(transformer),
+            (tokens,),
+            output,
+            input_names=["tokens"],
+            output_names=["mv_pred", "elo_pred"],
+            dynamic_axes={
+                "tokens": {0: "batch", 1: "seq"},
+                "mv_pred": {0: "batch", 1: "seq"},
+                "elo_pred": {0: "batch", 1: "seq"},
+            },
+            opset_version=args.opset,
+        )
+    print(f"wrote {output}")
+
+    if args.check_len:
+        # compare against the complex rotary embedding used by the bot
+        transformer.freqs_cis = torch.view_as_complex(transformer.freqs_cis)
+        check(transformer, output, min(args.check_len, 2 * model_args.max_seq_len))
+
+
+if __name__ == "__main__":
+    main()
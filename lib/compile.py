@@ -0,0 +1,42 @@
+"""Optional torch.compile backend for the inference model."""
+
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def bucket_lengths(max_len: int, smallest: int = 16) -> list[int]:
+    """Sequence lengths that full-sequence inputs are padded up to."""
+    lengths = []
+    length = smallest
+    while length < max_len:
+        lengths.append(length)
+        length *= 2
+    lengths.append(max_len)
+    return lengths
+
+
+def compile_cache_dir(model_dir: str, model_id: str) -> str:
+    """Where compiled artifacts are kept, keyed by model and torch version."""
+    return os.path.join(
+        model_dir, "compile_cache", f"{model_id}-torch-{torch.__version__}"
+    )
+
+
+def compile_model(model: torch.nn.Module, cache_dir: str) -> None:
+    """
+    Compile a module in place with torch.compile.
+
+    Inductor keeps its compiled graphs and kernels under `cache_dir`, so a
+    restarted worker reloads them instead of compiling again.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    logger.info(f"compiling model with artifact cache {cache_dir}")
+    # the KV cache and start positions change every move, so trace with
+    # dynamic shapes rather than recompiling for each length
+    model.compile(dynamic=True)
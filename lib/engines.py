@@ -0,0 +1,207 @@
+"""
+Inference engines behind `MimicBotCore`.
+
+An engine is called like `Transformer.forward` and returns the same
+`(mv_pred, elo_pred)` outputs, with move predictions always carrying a color
+axis of size 2. `supports_cache` tells the caller whether it may pass a
+`KVCache` and feed only the new tokens of a game.
+"""
+
+import numpy as np
+import torch
+
+from lib.kvcache import KVCache
+
+
+def expand_colors(mv_pred, move_head):
+    # give every model a color axis of size 2
+    if move_head is not None:
+        if move_head[2] is None and mv_pred.ndim == 3:
+            mv_pred = mv_pred[:, :, None].expand(-1, -1, 2, -1)
+    elif mv_pred.ndim == 5:
+        mv_pred = mv_pred[:, :, :, :,
+                          None].expand(-1, -1, -1, -1, 2, -1)
+    elif mv_pred.shape[4] == 1:
+        mv_pred = mv_pred.expand(-1, -1, -1, -1, 2, -1)
+    return mv_pred
+
+
+class Wrapper(torch.nn.Module):
+    """Eager (or torch.compile'd) pytorch inference."""
+
+    supports_cache = True
+
+    def __init__(self, ptmodel, buckets=None):
+        """:param buckets: Lengths that uncached inputs are right-padded up to."""
+        super().__init__()
+        self.model = ptmodel
+        self.buckets = buckets
+        # set once the model is torch.compile'd
+        self.compiled = False
+        # forwards run with early exit enabled, the tokens they added and the
+        # layers run for every token they fed, counting tokens fed again
+        # after an earlier call exited
+        self.exit_forwards = 0
+        self.exit_tokens = 0
+        self.exit_token_layers = 0
+
+    def forward(
+        self,
+        inp,
+        start_pos=0,
+        cache=None,
+        move_head=None,
+        elo_head=None,
+        last_n=None,
+        elo_only=False,
+        rows=None,
+        early_exit=None,
+    ):
+        """
+        :param move_head: `(timecontrol, elo, color)` indices of the only move head
+            to evaluate; the move prediction is then `(bs, seqlen, vocab)`, or
+            `(bs, seqlen, 2, vocab)` when color is None.
+        :param elo_head: Index of the only timecontrol elo head to evaluate.
+        :param last_n: Only compute outputs for the last `last_n` positions.
+        :param elo_only: Skip the move heads entirely; the move prediction is None.
+        :param rows: Vocabulary ids of the only moves to compute logits for,
+            with `move_head`; the vocab axis then holds just those, in order.
+        :param early_exit: `(layers, min_top1, max_entropy)` of
+            `Transformer.forward`.
+        """
+        with torch.inference_mode():
+            fed = cache.ntokens if isinstance(cache, KVCache) else None
+            pad = self._bucket_padding(inp, start_pos, cache)
+            if pad > 0:
+                # right padding follows every real token, so the causal mask
+                # keeps it out of the outputs that are kept
+                inp = torch.nn.functional.pad(inp, (0, pad))
+                if last_n is not None:
+                    last_n += pad
+                # the exit test reads the last position, which is padding
+                early_exit = None
+            if self.compiled:
+                # compile one graph for every length instead of recompiling
+                # for each; lengths of 1 are always specialized
+                if inp.shape[1] > 1:
+                    torch._dynamo.maybe_mark_dynamic(inp, 1)
+                if rows is not None and len(rows) > 1:
+                    torch._dynamo.maybe_mark_dynamic(rows, 0)
+            mv_pred, elo_pred = self.model(
+                inp, start_pos, cache, move_head, elo_head, last_n, elo_only,
+                rows, early_exit)
+            if early_exit is not None:
+                self._count_exit(inp, cache, fed)
+            if pad > 0:
+                mv_pred = None if mv_pred is None else mv_pred[:, :-pad]
+                elo_pred = None if elo_pred is None else elo_pred[:, :-pad]
+            if mv_pred is not None:
+                mv_pred = expand_colors(mv_pred, move_head)
+
+            return mv_pred, elo_pred
+
+    def _count_exit(self, inp, cache, fed):
+        bsz, seqlen = inp.shape
+        depth = self.model.exit_depth
+        new = seqlen
+        if fed is not None:
+            new = fed + seqlen - max(fed, cache.exited_until)
+            if depth < self.model.n_layers:
+                cache.exited_until = fed + seqlen
+        self.exit_forwards += 1
+        self.exit_tokens += bsz * new
+        self.exit_token_layers += bsz * seqlen * depth
+
+    def exit_metrics(self) -> dict:
+        """
+        The layers run per token, against every layer for each token once.
+        With a KV cache the tokens of an exited call are fed again by the
+        next one, so this can exceed the number of layers.
+        """
+        n_layers = self.model.n_layers
+        mean_depth = self.exit_token_layers / max(self.exit_tokens, 1)
+        return {
+            "forwards": self.exit_forwards,
+            "tokens": self.exit_tokens,
+            "mean_layers": mean_depth,
+            "layers_saved": 1 - mean_depth / n_layers if self.exit_tokens else 0.0,
+        }
+
+    def _bucket_padding(self, inp, start_pos, cache):
+        if self.buckets is None or cache is not None or not isinstance(start_pos, int):
+            return 0
+        seqlen = inp.shape[1]
+        for length in self.buckets:
+            if length >= seqlen:
+                return length - seqlen
+        return 0
+
+
+class OnnxEngine:
+    """
+    A model exported by export_onnx.py, run through onnxruntime on the CPU.
+
+    The exported graph takes the whole token sequence and computes every
+    timecontrol/elo head; the heads asked for are selected afterwards. It
+    keeps no attention state between calls, so every call reprocesses the
+    full game.
+    """
+
+    supports_cache = False
+    buckets = None
+
+    def __init__(self, path: str, threads: int | None = None):
+        """
+        :param path: The exported .onnx file.
+        :param threads: Intra-op threads; onnxruntime picks when None.
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(
+        self,
+        inp,
+        start_pos=0,
+        cache=None,
+        move_head=None,
+        elo_head=None,
+        last_n=None,
+        elo_only=False,
+        rows=None,
+        early_exit=None,
+    ):
+        """
+        Same arguments and outputs as `Wrapper.forward`, without a cache. The
+        exported graph always runs every layer, so `early_exit` is ignored.
+        """
+        if cache is not None or not isinstance(start_pos, int) or start_pos != 0:
+            raise Exception("onnx engine only runs full sequences")
+        mv_pred, elo_pred = self.session.run(
+            ["mv_pred", "elo_pred"], {"tokens": inp.numpy().astype(np.int64)}
+        )
+        mv_pred = torch.from_numpy(mv_pred)
+        elo_pred = torch.from_numpy(elo_pred)
+        if last_n is not None:
+            mv_pred = mv_pred[:, -last_n:]
+            elo_pred = elo_pred[:, -last_n:]
+        if elo_head is not None:
+            elo_pred = elo_pred[:, :, elo_head, None]
+        if elo_only:
+            return None, elo_pred
+
+        mv_pred = expand_colors(mv_pred, None)
+        if move_head is not None:
+            tc, elo, color = move_head
+            mv_pred = mv_pred[:, :, tc, elo]
+            if color is not None:
+                mv_pred = mv_pred[:, :, color]
+            if rows is not None:
+                mv_pred = mv_pred[..., rows]
+        return mv_pred, elo_pred
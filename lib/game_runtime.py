@@ -0,0 +1,192 @@
+"""Many games played from one process on an asyncio event loop."""
+
+import asyncio
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.client import RemoteDisconnected
+from urllib.parse import urljoin
+
+import aiohttp
+from requests.exceptions import (
+    ChunkedEncodingError,
+    ConnectionError,
+    HTTPError,
+    ReadTimeout,
+)
+
+from lib import lichess
+from lib.play_game import GameSession, engine, game_is_active
+
+logger = logging.getLogger(__name__)
+
+# like the requests timeout of `Lichess.get_game_stream`; lichess sends a
+# keep-alive line every few seconds
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=15)
+
+
+class StreamClosed(Exception):
+    """The game stream ended."""
+
+
+# errors of the game stream, after which it is opened again
+STREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, StreamClosed)
+# errors of the blocking lichess calls, e.g. `make_move`, as caught by `play_game`
+REQUEST_ERRORS = (
+    HTTPError,
+    ReadTimeout,
+    RemoteDisconnected,
+    ChunkedEncodingError,
+    ConnectionError,
+)
+
+
+class AsyncGameRuntime:
+    """
+    Hold the stream of every game this process plays on a single event loop.
+
+    The loop runs in its own thread, so `start_game` returns as soon as the
+    game is registered. A game waiting for its opponent costs an open socket
+    rather than a worker. The engine's moves are computed on a dedicated
+    pool of `inference_workers` threads, whose concurrent `predict` calls
+    are batched when the `InferenceScheduler` is enabled; chat messages go
+    through the engine's `SideEffectWriter` and the other blocking lichess
+    calls run on the loop's default executor.
+    """
+
+    def __init__(
+        self,
+        li: lichess.Lichess,
+        config,
+        username: str,
+        inference_workers: int | None = None,
+        on_finish=None,
+    ) -> None:
+        """
+        :param config: The bot config passed to `play_game`.
+        :param inference_workers: Threads computing moves; defaults to the scheduler's
+            max batch size, or 1 without batching.
+        :param on_finish: Called with the game id when a game ends.
+        """
+        self.li = li
+        self.config = config
+        self.username = username
+        self.on_finish = on_finish
+        if inference_workers is None:
+            scheduler = engine.scheduler
+            inference_workers = 1 if scheduler is None else scheduler.max_batch_size
+        self.inference = ThreadPoolExecutor(
+            inference_workers, thread_name_prefix="inference"
+        )
+        self.games: set[str] = set()
+
+        self.loop = asyncio.new_event_loop()
+        self.http = None
+        started = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, args=(started,), name="game-runtime", daemon=True
+        )
+        self.thread.start()
+        started.wait()
+
+    def start_game(self, game_id: str) -> None:
+        """Play a game in the background."""
+        asyncio.run_coroutine_threadsafe(self._play(game_id), self.loop)
+
+    def metrics(self) -> dict:
+        return {"games": len(self.games)}
+
+    def _run(self, started: threading.Event) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._open_session())
+        started.set()
+        self.loop.run_forever()
+
+    async def _open_session(self) -> None:
+        # the session has to be created on the loop that uses it
+        self.http = aiohttp.ClientSession(
+            headers=self.li.header, timeout=STREAM_TIMEOUT
+        )
+
+    async def _open_stream(self, game_id: str):
+        path_template = lichess.ENDPOINTS["stream"]
+        if self.li.rate_limiter is not None:
+            await asyncio.to_thread(self.li.rate_limiter.acquire, path_template)
+        url = urljoin(self.li.baseUrl, path_template.format(game_id))
+        response = await self.http.get(url)
+        response.raise_for_status()
+        # the first line of the stream is the full game info
+        initial_state = json.loads(await response.content.readline())
+        return response, initial_state
+
+    async def _next_update(self, response) -> dict:
+        line = await response.content.readline()
+        if not line:
+            raise StreamClosed()
+        line = line.strip()
+        return json.loads(line) if line else {}
+
+    async def _play(self, game_id: str) -> None:
+        self.games.add(game_id)
+        try:
+            await self._play_game(game_id)
+        except Exception:
+            logger.exception(f"game {game_id} failed")
+        finally:
+            self.games.discard(game_id)
+            if self.on_finish is not None:
+                self.on_finish(game_id)
+
+    async def _play_game(self, game_id: str) -> None:
+        loop = asyncio.get_running_loop()
+        response, initial_state = await self._open_stream(game_id)
+        engine.writer.chat(self.li, game_id, "player", json.dumps(engine.default_elo()))
+        logger.info(f"Initial state: {initial_state}")
+        # registering the game writes to xata and the shared ongoing games
+        session = await asyncio.to_thread(
+            GameSession, game_id, self.li, self.config, self.username, initial_state
+        )
+
+        pending = [session.game.state]
+        stay_in_game = True
+        try:
+            while stay_in_game:
+                move_attempted = False
+                try:
+                    upd = pending.pop() if pending else await self._next_update(response)
+                    u_type = upd["type"] if upd else "ping"
+                    if u_type == "gameState":
+                        if session.update(upd):
+                            move_attempted = True
+                            move = await loop.run_in_executor(
+                                self.inference, session.play_move
+                            )
+                            if move is None:
+                                stay_in_game = False
+                            else:
+                                engine.writer.chat(
+                                    self.li, game_id, "player", json.dumps(move.info)
+                                )
+                        session.ping(upd)
+
+                    elif u_type == "ping" and await asyncio.to_thread(session.should_exit):
+                        logger.info("should_exit_game returned true")
+                        stay_in_game = False
+                except STREAM_ERRORS + REQUEST_ERRORS as e:
+                    stopped = isinstance(e, StreamClosed)
+                    stay_in_game = not stopped and (
+                        move_attempted
+                        or await asyncio.to_thread(game_is_active, self.li, game_id)
+                    )
+                    logger.info(
+                        f"exception caught: {e}, stopped = {stopped}, stay_in_game = {stay_in_game}"
+                    )
+                    if stay_in_game and isinstance(e, STREAM_ERRORS):
+                        # resume from a new stream, starting with the current state
+                        response.close()
+                        response, full_state = await self._open_stream(game_id)
+                        pending = [full_state["state"]]
+        finally:
+            response.close()
+            await asyncio.to_thread(session.end)
@@ -0,0 +1,155 @@
+"""Per-game key/value caches for incremental decoding."""
+
+import torch
+
+
+class LayerCache:
+    """Key and value tensors for a single attention layer."""
+
+    def __init__(self, cache_k: torch.Tensor, cache_v: torch.Tensor):
+        self.cache_k = cache_k
+        self.cache_v = cache_v
+
+    def update(
+        self, start_pos: int, xk: torch.Tensor, xv: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Store the keys/values of the new tokens and return every key/value seen so far.
+
+        :param start_pos: The position of the first new token.
+        :param xk: Keys of shape (bsz, seqlen, n_kv_heads, head_dim).
+        :param xv: Values of shape (bsz, seqlen, n_kv_heads, head_dim).
+        """
+        bsz, seqlen = xk.shape[:2]
+        end = start_pos + seqlen
+        self.cache_k[:bsz, start_pos:end] = xk
+        self.cache_v[:bsz, start_pos:end] = xv
+        return self.cache_k[:bsz, :end], self.cache_v[:bsz, :end]
+
+
+class KVCache:
+    """
+    Attention state of every layer of a `Transformer` for one token sequence.
+
+    `Transformer.forward` extends the cache when it is passed one, so that a
+    caller only needs to feed the tokens that have not been seen yet, starting
+    at `start_pos=cache.seqlen`.
+    """
+
+    def __init__(self, params, max_seq_len: int | None = None, dtype=torch.float32):
+        """
+        :param params: The `ModelArgs` of the model the cache belongs to.
+        :param max_seq_len: The number of positions to allocate; defaults to the
+            length of the model's rotary embedding table.
+        """
+        n_kv_heads = params.n_heads if params.n_kv_heads is None else params.n_kv_heads
+        head_dim = params.dim // params.n_heads
+        self.max_seq_len = max_seq_len or 2 * params.max_seq_len
+        shape = (1, self.max_seq_len, n_kv_heads, head_dim)
+        self.layers = [
+            LayerCache(torch.zeros(shape, dtype=dtype), torch.zeros(shape, dtype=dtype))
+            for _ in range(params.n_layers)
+        ]
+        self.seqlen = 0
+        self.evicted = 0
+        # like ntokens, the end of the tokens fed by a call that exited early;
+        # the cache was not advanced past them, so the next call feeds them again
+        self.exited_until = 0
+
+    @property
+    def ntokens(self) -> int:
+        """The number of tokens fed so far, including evicted ones."""
+        return self.seqlen + self.evicted
+
+    def __getitem__(self, layer_id: int) -> LayerCache:
+        return self.layers[layer_id]
+
+    def advance(self, seqlen: int) -> None:
+        """Record that `seqlen` more tokens have been written to every layer."""
+        self.seqlen += seqlen
+
+    def evict(self, n: int, freqs_cis: torch.Tensor, sink: int = 1) -> None:
+        """
+        Drop the `n` oldest tokens after the first `sink` ones and move the rest
+        down into their slots.
+
+        The moved keys are rotated back by `n` positions, so every cached key
+        carries the rotary embedding of the slot it now occupies and the
+        positions of later tokens stay within the rotary table.
+
+        :param freqs_cis: The model's rotary table.
+        """
+        end = self.seqlen
+        keep = end - sink - n
+        rotation = freqs_cis[n].conj()
+        for layer in self.layers:
+            keys = layer.cache_k[0, sink + n : end]
+            keys_ = torch.view_as_complex(keys.float().reshape(*keys.shape[:-1], -1, 2))
+            keys = torch.view_as_real(keys_ * rotation).flatten(-2).type_as(keys)
+            layer.cache_k[0, sink : sink + keep] = keys
+            layer.cache_v[0, sink : sink + keep] = layer.cache_v[0, sink + n : end].clone()
+        self.seqlen -= n
+        self.evicted += n
+
+    def truncate(self, seqlen: int) -> None:
+        """Forget every token from position `seqlen` on; they are overwritten by the next tokens fed."""
+        self.seqlen = seqlen
+
+
+class BatchLayerCache:
+    """One attention layer of a `BatchKVCache`."""
+
+    def __init__(self, layers: list[LayerCache], batch: "BatchKVCache"):
+        self.layers = layers
+        self.batch = batch
+
+    def update(
+        self, start_pos: torch.Tensor, xk: torch.Tensor, xv: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Write the unpadded tail of each row into that row's own cache and return
+        the keys/values of the whole batch, stacked and padded to the longest row.
+        """
+        width = xk.shape[1]
+        for i, layer in enumerate(self.layers):
+            pos = self.batch.cached[i]
+            seqlen = self.batch.seqlens[i]
+            layer.cache_k[0, pos : pos + seqlen] = xk[i, width - seqlen :]
+            layer.cache_v[0, pos : pos + seqlen] = xv[i, width - seqlen :]
+        kvlen = self.batch.kvlen
+        keys = torch.cat([layer.cache_k[:, :kvlen] for layer in self.layers])
+        values = torch.cat([layer.cache_v[:, :kvlen] for layer in self.layers])
+        return keys, values
+
+
+class BatchKVCache:
+    """
+    A batch view over the `KVCache`s of several games.
+
+    The new tokens of each game are left-padded to a common width, so that the
+    last column of every row is that game's latest token. `start_pos` is the
+    per-row tensor to pass to `Transformer.forward`.
+    """
+
+    def __init__(self, caches: list[KVCache], seqlens: list[int]):
+        """
+        :param caches: One cache per row of the batch.
+        :param seqlens: The number of unpadded new tokens in each row.
+        """
+        self.caches = caches
+        self.seqlens = seqlens
+        self.cached = [cache.seqlen for cache in caches]
+        self.width = max(seqlens)
+        self.kvlen = max(pos + seqlen for pos, seqlen in zip(self.cached, seqlens))
+        self.start_pos = torch.tensor(
+            [pos + seqlen - self.width for pos, seqlen in zip(self.cached, seqlens)],
+            dtype=torch.long,
+        )
+
+    def __getitem__(self, layer_id: int) -> BatchLayerCache:
+        return BatchLayerCache([cache[layer_id] for cache in self.caches], self)
+
+    def advance(self, seqlen: int) -> None:
+        """Advance every game's cache by its own number of unpadded tokens."""
+        for cache, n in zip(self.caches, self.seqlens):
+            cache.advance(n)
@@ -31,6 +31,8 @@ from lib.lichess_types import (
     PublicDataType,
     UserProfileType,
 )
+from lib.ongoing_games import OngoingGames
+from lib.rate_limit import RateLimiter
 from lib.timer import Timer, sec_str, seconds
 
 ENDPOINTS = {
@@ -95,7 +97,13 @@ class Lichess:
     """Communication with lichess.org (and chessdb.cn for getting moves)."""
 
     def __init__(
-        self, token: str, url: str, version: str, logging_level: int, max_retries: int
+        self,
+        token: str,
+        url: str,
+        version: str,
+        logging_level: int,
+        max_retries: int,
+        rate_limiter: Optional[RateLimiter] = None,
     ) -> None:
         """
         Communication with lichess.org (and chessdb.cn for getting moves).
@@ -105,6 +113,8 @@ class Lichess:
         :param version: The lichess-bot version running.
         :param logging_level: The logging level (logging.INFO or logging.DEBUG).
         :param max_retries: The maximum amount of retries for online moves (e.g. chessdb's opening book).
+        :param rate_limiter: Paces requests to lichess.org; without one, a rate-limited
+            endpoint raises `RateLimitedError` until its delay has passed.
         """
         self.version = version
         self.header = {"Authorization": f"Bearer {token}"}
@@ -116,6 +126,9 @@ class Lichess:
         self.logging_level = logging_level
         self.max_retries = max_retries
         self.rate_limit_timers: defaultdict[str, Timer] = defaultdict(Timer)
+        self.rate_limiter = rate_limiter
+        # set to share get_ongoing_games results between calls and processes
+        self.ongoing_games: Optional[OngoingGames] = None
 
         # Confirm that the OAuth token has the proper permission to play on lichess
         token_response = cast(TOKEN_TESTS_TYPE, self.api_post("token_test", data=token))
@@ -283,13 +296,16 @@ class Lichess:
 
     def get_path_template(self, endpoint_name: str) -> str:
         """
-        Get the path template given the endpoint name. Will raise an exception if the path template is rate limited.
+        Get the path template given the endpoint name. Waits for the rate limiter if there
+        is one, and otherwise raises an exception if the path template is rate limited.
 
         :param endpoint_name: The name of the endpoint.
         :return: The path template.
         """
         path_template = ENDPOINTS[endpoint_name]
-        if self.is_rate_limited(path_template):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(path_template, move=endpoint_name == "move")
+        elif self.is_rate_limited(path_template):
             raise RateLimitedError(
                 f"{path_template} is rate-limited. "
                 f"Will retry in {sec_str(self.rate_limit_time_left(path_template))} seconds."
@@ -305,6 +321,9 @@ class Lichess:
         :param path_template: The path template.
         :param delay_time: How long we won't call this endpoint.
         """
+        if self.rate_limiter is not None:
+            self.rate_limiter.block(path_template, delay_time)
+            return
         logger.warning(
             f"Endpoint {path_template} is rate limited. Waiting {sec_str(delay_time)} seconds until next request."
         )
@@ -399,12 +418,19 @@ class Lichess:
         self.set_user_agent(profile["username"])
         return profile
 
+    def fetch_ongoing_games(self) -> list[GameType]:
+        """Get the bot's ongoing games from lichess.org."""
+        response = cast(dict[str, list[GameType]], self.api_get_json("playing"))
+        return response["nowPlaying"]
+
     def get_ongoing_games(self) -> list[GameType]:
-        """Get the bot's ongoing games."""
+        """Get the bot's ongoing games, from `ongoing_games` when it is set."""
         ongoing_games: list[GameType] = []
         with contextlib.suppress(Exception):
-            response = cast(dict[str, list[GameType]], self.api_get_json("playing"))
-            ongoing_games = response["nowPlaying"]
+            if self.ongoing_games is not None:
+                ongoing_games = self.ongoing_games.get()
+            else:
+                ongoing_games = self.fetch_ongoing_games()
         return ongoing_games
 
     def resign(self, game_id: str) -> None:
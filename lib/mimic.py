@@ -1,37 +1,160 @@
 import os
+import contextlib
+import logging
+import threading
+import copy
 import pathlib
 import hashlib
 import io
+from typing import Iterable, Iterator
 
 import chess
 import chess.pgn
 from chess.engine import PlayResult
-import numpy as np
 import torch
 from xata.client import XataClient
 from lib.models import get_config
-from lib.models.latest import ModelArgs, Transformer
-from lib.pgnutils import STARTMV, BoardState, IllegalMoveException
+from lib.models.config import Config
+from lib.models.latest import MODEL_ID, ModelArgs, Transformer
+from lib.models.latest.model import precompute_freqs_cis
+from lib.pgnutils import STARTMV, BoardState
 from lib import model, lichess
+from lib.kvcache import KVCache, BatchKVCache
+from lib.scheduler import InferenceScheduler
+from lib.quantize import quantize
+from lib.compile import bucket_lengths, compile_cache_dir, compile_model
+from lib.engines import OnnxEngine, Wrapper
+from lib.prediction_cache import Prediction, PredictionCache
+from lib.opening_table import OpeningTable
+from lib.prefix_cache import PrefixKVCache
+from lib.ponder import Ponderer
+from lib.side_effects import SideEffectWriter
+from lib.timer import Timer, seconds
+
+logger = logging.getLogger(__name__)
 
 xata = XataClient()
 
 
+UNSUPPORTED_FEN = {
+    "success": False,
+    "reason": "Non-standard opening positions are not supported",
+}
+READ_ERROR = {"success": False, "reason": "Error reading PGN"}
+
+
 def add_move(mvid, inp):
     mv = torch.tensor([[mvid]], dtype=torch.int32)
     return torch.cat([inp, mv], dim=1)
 
 
+def pgn_game_id(game: chess.pgn.Game) -> str:
+    if "GameId" in game.headers:
+        return "pgn-" + game.headers["GameId"]
+    elif "Link" in game.headers:
+        return "pgn-" + hashlib.sha256(game.headers["Link"].encode()).hexdigest()[:8]
+    else:
+        return "pgn-abcdefgh"
+
+
+def tokenize_game(game: chess.pgn.Game) -> tuple[list[str], torch.Tensor]:
+    """Get the uci moves of a game's mainline and its model input tokens."""
+    board = BoardState()
+    moves = []
+    mvids = [STARTMV]
+    for move in game.mainline_moves():
+        moves.append(move.uci())
+        mvid = board.uci_to_mvid(moves[-1])
+        board.update(mvid)
+        mvids.append(mvid)
+    return moves, torch.tensor([mvids], dtype=torch.int32)
+
+
+def board_state(board: chess.Board) -> BoardState:
+    """The model's view of a standard game's position."""
+    state = BoardState()
+    for move in board.move_stack:
+        state.update(state.uci_to_mvid(move.uci()))
+    return state
+
+
+def length_buckets(items: list, length, max_batch_size: int, bucket_width: int):
+    """
+    Group items into batches of similar length to limit padding.
+
+    :param length: Gets the sequence length of an item.
+    :param max_batch_size: The largest number of items in a batch.
+    :param bucket_width: Items are only batched together if their lengths fall
+        in the same `bucket_width`-wide range.
+    """
+    batch = []
+    bucket = None
+    for item in sorted(items, key=length):
+        item_bucket = (length(item) - 1) // bucket_width
+        if batch and (len(batch) == max_batch_size or item_bucket != bucket):
+            yield batch
+            batch = []
+        batch.append(item)
+        bucket = item_bucket
+    if batch:
+        yield batch
+
+
 class MimicBot:
     def __init__(self):
         self.core = MimicBotCore()
         self.games = {}
+        # chat messages and elo records are written off the move's critical path
+        self.writer = SideEffectWriter(xata)
+
+        batching = self.core.inference.batching
+        self.scheduler = None
+        if batching.enabled:
+            self.scheduler = InferenceScheduler(
+                self.core,
+                max_batch_size=batching.max_batch_size,
+                max_wait_ms=batching.max_wait_ms,
+                max_queue_depth=batching.max_queue_depth,
+                metrics_interval=batching.metrics_interval,
+            )
+
+        ponder = self.core.inference.ponder
+        self.ponderer = None
+        if ponder.enabled and self.core.model.supports_cache:
+            self.ponderer = Ponderer(
+                self.core, ponder.top_k, ponder.workers, ponder.metrics_interval
+            )
+
+        # every process logs its own counters; /metrics only sees the web process
+        self.metrics_interval = self.core.inference.metrics_interval
+        self.metrics_timer = Timer(seconds(self.metrics_interval))
+        self.metrics_lock = threading.Lock()
+
+    def metrics(self) -> dict:
+        metrics = {} if self.scheduler is None else self.scheduler.metrics()
+        metrics["side_effects"] = self.writer.metrics()
+        if self.core.prediction_cache is not None:
+            metrics["prediction_cache"] = self.core.prediction_cache.metrics()
+        if self.core.prefix_cache is not None:
+            metrics["prefix_cache"] = self.core.prefix_cache.metrics()
+        if self.ponderer is not None:
+            metrics["ponder"] = self.ponderer.metrics()
+        if self.core.early_exit is not None:
+            metrics["early_exit"] = self.core.model.exit_metrics()
+        return metrics
+
+    def _log_metrics(self) -> None:
+        with self.metrics_lock:
+            if not self.metrics_interval or not self.metrics_timer.is_expired():
+                return
+            self.metrics_timer.reset()
+        logger.info(f"engine: {self.metrics()}")
 
     def default_elo(self):
         return self.core.default_elo
 
     def _update_xata(self, gameId):
-        xata.records().update(
+        self.writer.update_record(
             "game",
             gameId,
             {
@@ -45,48 +168,98 @@ class MimicBot:
         self.games[gameId] = {
             "board": BoardState(),
             "inp": torch.tensor([[STARTMV]], dtype=torch.int32),
+            "cache": self.core.new_cache(),
             "welo": f"{int(m)},{int(s**2)}",
             "belo": f"{int(m)},{int(s**2)}",
         }
         self._update_xata(gameId)
 
     def analyze_pgn(self, pgn: io.StringIO) -> dict:
-        board = BoardState()
-        inp = torch.tensor([[STARTMV]], dtype=torch.int32)
         try:
             game = chess.pgn.read_game(pgn)
             if "FEN" in game.headers:
-                return {
-                    "success": False,
-                    "reason": "Non-standard opening positions are not supported",
-                }
-
-            if "GameId" in game.headers:
-                gameId = "pgn-" + game.headers["GameId"]
-            elif "Link" in game.headers:
-                gameId = (
-                    "pgn-"
-                    + hashlib.sha256(game.headers["Link"].encode()).hexdigest()[:8]
+                return UNSUPPORTED_FEN
+
+            moves, inp = tokenize_game(game)
+            elo_preds = self.core.elo_analysis(inp)
+            welos, belos = self._split_elo_analysis(elo_preds)
+        except Exception:
+            return READ_ERROR
+
+        return self._analysis_result(game, moves, welos, belos)
+
+    def analyze_pgns(self, pgns: Iterable[io.StringIO]) -> Iterator[dict]:
+        """
+        Analyze every game in several (possibly multi-game) PGNs.
+
+        Games are grouped into padded batches of similar length; the results of
+        a batch are yielded as soon as it has run, so they are not in input
+        order. Each result carries the `index` of its game in the input.
+        """
+        analysis = self.core.inference.analysis
+        pending = []
+        index = 0
+        for pgn in pgns:
+            while True:
+                try:
+                    game = chess.pgn.read_game(pgn)
+                    if game is None:
+                        break
+                    if "FEN" in game.headers:
+                        yield {"index": index, **UNSUPPORTED_FEN}
+                    else:
+                        moves, inp = tokenize_game(game)
+                        if inp.shape[1] > self.core.window:
+                            # too long to pad into a batch; analyzed in chunks
+                            elo_preds = self.core.elo_analysis(inp)
+                            welos, belos = self._split_elo_analysis(elo_preds)
+                            result = self._analysis_result(game, moves, welos, belos)
+                            yield {"index": index, **result}
+                        else:
+                            pending.append((index, game, moves, inp))
+                except Exception:
+                    yield {"index": index, **READ_ERROR}
+                index += 1
+
+        batches = length_buckets(
+            pending,
+            lambda item: item[3].shape[1],
+            analysis.max_batch_size,
+            analysis.bucket_width,
+        )
+        for batch in batches:
+            lengths = [inp.shape[1] for _, _, _, inp in batch]
+            tokens = torch.zeros((len(batch), max(lengths)), dtype=torch.int32)
+            for j, (_, _, _, inp) in enumerate(batch):
+                tokens[j, : lengths[j]] = inp[0]
+            try:
+                # right padding only ever follows the real tokens, so the
+                # causal mask keeps it out of every row's predictions
+                _, elo_preds = self.core.model(
+                    tokens, elo_head=self.core.elo_head, elo_only=True
                 )
-            else:
-                gameId = "pgn-abcdefgh"
-            moves = []
-            for move in game.mainline_moves():
-                moves.append(move.uci())
-                mvid = board.uci_to_mvid(moves[-1])
-                board.update(mvid)
-                inp = add_move(mvid, inp)
-            _, elo_preds = self.core.model(inp)
-            ms, ss = self.core.create_elo_analysis(elo_preds)
-            msss = torch.stack((ms, ss), dim=1)
-            welos = msss[::2].reshape(-1)
-            belos = msss[1::2].reshape(-1)
-        except Exception as e:
-            return {"success": False, "reason": "Error reading PGN"}
-
+            except Exception:
+                elo_preds = None
+
+            for j, (index, game, moves, _) in enumerate(batch):
+                result = READ_ERROR
+                if elo_preds is not None:
+                    with contextlib.suppress(Exception):
+                        welos, belos = self._split_elo_analysis(
+                            elo_preds[j : j + 1, : lengths[j]]
+                        )
+                        result = self._analysis_result(game, moves, welos, belos)
+                yield {"index": index, **result}
+
+    def _split_elo_analysis(self, elo_preds) -> tuple[torch.Tensor, torch.Tensor]:
+        ms, ss = self.core.create_elo_analysis(elo_preds)
+        msss = torch.stack((ms, ss), dim=1)
+        return msss[::2].reshape(-1), msss[1::2].reshape(-1)
+
+    def _analysis_result(self, game, moves, welos, belos) -> dict:
         return {
             "success": True,
-            "gameId": gameId,
+            "gameId": pgn_game_id(game),
             "moves": moves,
             "welos": welos.tolist(),
             "belos": belos.tolist(),
@@ -97,6 +270,8 @@ class MimicBot:
         }
 
     def remove_game(self, gameId):
+        if self.ponderer is not None:
+            self.ponderer.finish(gameId)
         del self.games[gameId]
 
     def play_move(
@@ -107,6 +282,13 @@ class MimicBot:
     ) -> PlayResult:
         best_move = self.search(board, game.id)
         li.make_move(game.id, best_move)
+        self._log_metrics()
+        if self.ponderer is not None:
+            # prepare for the opponent's likeliest replies while they think
+            after = board.copy()
+            after.push_uci(str(best_move.move))
+            state = self.games[game.id]
+            self.ponderer.start(game.id, after, state["inp"], state["cache"])
         return best_move
 
     def _update_elos(self, gameId: str, elo_preds: dict) -> None:
@@ -127,27 +309,82 @@ class MimicBot:
 
         core_state = self.games[gameId]["board"]
         inp = self.games[gameId]["inp"]
-        mv, elo_preds, inp = self.core.predict(last, core_state, inp)
+        cache = self.games[gameId]["cache"]
+        pondered = None
+        if self.ponderer is not None and last is not None:
+            key = (*inp[0].tolist(), core_state.uci_to_mvid(last))
+            pondered = self.ponderer.take(gameId, key)
+
+        if pondered is not None:
+            mv, elo_preds, inp = self.core.play_prediction(last, core_state, inp, pondered)
+        else:
+            predictor = self.scheduler
+            if predictor is None or self.core.in_opening_table(last, core_state, inp):
+                # book moves never wait for a batch
+                predictor = self.core
+            mv, elo_preds, inp = predictor.predict(last, core_state, board, inp, cache)
         self.games[gameId]["inp"] = inp
         self._update_elos(gameId, elo_preds)
         return PlayResult(mv, None, info=elo_preds)
 
 
-class Wrapper(torch.nn.Module):
-    def __init__(self, ptmodel):
-        super().__init__()
-        self.model = ptmodel
-
-    def forward(self, inp):
-        with torch.inference_mode():
-            mv_pred, elo_pred = self.model(inp)
-            if mv_pred.ndim == 5:
-                mv_pred = mv_pred[:, :, :, :,
-                                  None].expand(-1, -1, -1, -1, 2, -1)
-            elif mv_pred.shape[4] == 1:
-                mv_pred = mv_pred.expand(-1, -1, -1, -1, 2, -1)
-
-            return mv_pred, elo_pred
+INFERENCE_DEFAULTS = {
+    "precision": "fp32",
+    "backend": "eager",
+    "onnx_path": None,
+    "onnx_threads": None,
+    "fuse_weights": False,
+    "metrics_interval": 60,
+    "batching": {
+        "enabled": False,
+        "max_batch_size": 8,
+        "max_wait_ms": 5,
+        "max_queue_depth": 64,
+        "metrics_interval": 60,
+    },
+    "analysis": {
+        "max_batch_size": 16,
+        "bucket_width": 16,
+    },
+    "opening_table": None,
+    "prediction_cache": {
+        "enabled": False,
+        "max_entries": 100000,
+        "max_depth": 12,
+        "shared_path": None,
+    },
+    "prefix_cache": {
+        "enabled": False,
+        "memory_mb": 256,
+        "block_size": 16,
+    },
+    "early_exit": {
+        "layers": [],
+        "min_top1": 0.9,
+        "max_entropy": None,
+    },
+    "sliding_window": {
+        "window": None,
+        "evict_size": 32,
+    },
+    "ponder": {
+        "enabled": False,
+        "top_k": 3,
+        "workers": 1,
+        "metrics_interval": 60,
+    },
+}
+
+
+def get_inference_params(cfgyml):
+    """Merge the optional `inference` section of a model cfg.yml over the defaults."""
+    params = copy.deepcopy(INFERENCE_DEFAULTS)
+    for name, value in cfgyml.__dict__.get("inference", {}).items():
+        if isinstance(value, dict) and isinstance(params.get(name), dict):
+            params[name].update(value)
+        else:
+            params[name] = value
+    return Config(params)
 
 
 def get_model_args(cfgyml):
@@ -169,29 +406,258 @@ def get_model_args(cfgyml):
 
 
 class MimicBotCore:
-    def __init__(self, top_n=10, p_thresh=0.2):
+    def __init__(self, top_n=10, p_thresh=0.2, precision=None):
+        """:param precision: Overrides the `inference.precision` of the model config."""
         dn = pathlib.Path(__file__).parent.resolve()
         cfg = os.path.join(dn, "models", "latest", "cfg.yml")
         cfgyml = get_config(cfg)
         self.tc_groups = cfgyml.tc_groups
         self.whiten_params = cfgyml.elo_params.whiten_params
+        self.inference = get_inference_params(cfgyml)
         model_args = get_model_args(cfgyml)
-        self.model = Wrapper(Transformer(model_args))
-        cp = torch.load(
-            os.path.join(dn, "models", "latest", "weights.ckpt"),
-            map_location=torch.device("cpu"),
-            weights_only=True,
-        )
-        self.model.load_state_dict(cp)
-        self.model.eval()
+        self.model_args = model_args
+        model_dir = os.path.join(dn, "models", "latest")
 
         self.top_n = top_n
         self.p_thresh = p_thresh
+        # play with the last timecontrol/elo move head and read elo estimates
+        # from the first timecontrol head; moves only need the last position
+        # and elo estimates the last two
+        self.move_head = (-1, -1)
+        self.elo_head = 0
+        self.last_n = 2
 
         wm, ws = self.whiten_params
         def_elo = {"m": wm, "s": ws**2}
         self.default_elo = {"weloParams": def_elo, "beloParams": def_elo}
 
+        self.precision = precision or self.inference.precision
+        # built offline by build_opening_table.py and mapped, not read
+        table_path = self.inference.opening_table or os.path.join(
+            model_dir, "opening_table.bin"
+        )
+        self.opening_table = None
+        if self.inference.opening_table or os.path.exists(table_path):
+            self.opening_table = OpeningTable(table_path, MODEL_ID, self.default_elo)
+
+        cache_params = self.inference.prediction_cache
+        self.prediction_cache = None
+        if cache_params.enabled:
+            self.prediction_cache = PredictionCache(
+                max_entries=cache_params.max_entries,
+                max_depth=cache_params.max_depth,
+                shared_path=cache_params.shared_path,
+                namespace=f"{MODEL_ID}-{self.precision}-top{top_n}",
+            )
+        # games longer than the rotary table keep a sliding window of the
+        # start token and their latest moves
+        max_len = 2 * model_args.max_seq_len
+        self.window = min(self.inference.sliding_window.window or max_len, max_len)
+        self.evict_size = self.inference.sliding_window.evict_size
+        if not 0 < self.evict_size < self.window - 1:
+            # the start token and at least one new token have to stay in the window
+            raise Exception(
+                f"sliding_window.evict_size ({self.evict_size}) must be between "
+                f"1 and window - 2 ({self.window - 2})"
+            )
+        self.freqs_cis = precompute_freqs_cis(
+            model_args.dim // model_args.n_heads,
+            max_len,
+            model_args.rope_theta,
+        )
+
+        prefix_params = self.inference.prefix_cache
+        self.prefix_cache = None
+        if prefix_params.enabled:
+            self.prefix_cache = PrefixKVCache(
+                prefix_params.memory_mb, prefix_params.block_size
+            )
+        exit_params = self.inference.early_exit
+        self.early_exit = None
+        if exit_params.layers:
+            # sharp move distributions are returned from these layers
+            self.early_exit = (
+                tuple(exit_params.layers),
+                exit_params.min_top1,
+                exit_params.max_entropy,
+            )
+        if self.inference.backend == "onnx":
+            if self.precision != "fp32":
+                raise Exception("onnx backend only supports fp32 precision")
+            if self.early_exit is not None:
+                raise Exception("onnx backend does not support early exit")
+            self.model = OnnxEngine(
+                self.inference.onnx_path or os.path.join(model_dir, "model.onnx"),
+                self.inference.onnx_threads,
+            )
+            return
+
+        # build the module without allocating or initializing its weights;
+        # they are replaced by the checkpoint tensors below
+        with torch.device("meta"):
+            transformer = Transformer(model_args)
+        self.model = Wrapper(transformer)
+        # memory-map the checkpoint instead of reading it into this process:
+        # every worker maps the same read-only file pages, so N workers share
+        # one copy of the weights through the page cache
+        cp = torch.load(
+            os.path.join(model_dir, "weights.ckpt"),
+            map_location=torch.device("cpu"),
+            weights_only=True,
+            mmap=True,
+        )
+        self.model.load_state_dict(cp, assign=True)
+        # not part of the checkpoint, so rebuild it off the meta device
+        transformer.freqs_cis = precompute_freqs_cis(
+            model_args.dim // model_args.n_heads,
+            max_len,
+            model_args.rope_theta,
+        )
+        self.model.eval()
+        if self.inference.fuse_weights:
+            transformer.fuse_weights()
+        self.model = quantize(self.model, self.precision)
+
+        if self.inference.backend == "compile":
+            self.model.buckets = bucket_lengths(2 * model_args.max_seq_len)
+            # inductor cannot generate code for complex ops, so rotate on the
+            # real and imaginary parts as in the onnx export
+            transformer.freqs_cis = torch.view_as_real(
+                transformer.freqs_cis
+            ).contiguous()
+            # built outside the compiled forward, which then only reads it
+            transformer.build_causal_mask(transformer.freqs_cis.device)
+            compile_model(transformer, compile_cache_dir(model_dir, MODEL_ID))
+            self.model.compiled = True
+            self.warmup()
+        elif self.inference.backend != "eager":
+            raise Exception(f"did not recognize backend {self.inference.backend}")
+
+    def warmup(self) -> None:
+        """
+        Run the inputs of play and analysis once so they compile before any
+        request. torch.compile specializes lengths, batch sizes and start
+        positions of 0 and 1, so every combination play reaches is run: the
+        first one or two tokens of a game, the next move after one, two or
+        more cached tokens, single-token decodes, and the batched forms.
+        """
+        for length in self.model.buckets or []:
+            tokens = torch.full((1, length), STARTMV, dtype=torch.int32)
+            self.model(tokens, elo_head=self.elo_head, elo_only=True)
+        tokens = torch.full((1, 3), STARTMV, dtype=torch.int32)
+        legal = self._legal_mvids(BoardState(), chess.Board())
+        for start_pos in range(3):
+            for seqlen in range(1, 4):
+                for color in range(2):
+                    cache = self.new_cache()
+                    if start_pos > 0:
+                        self.model(
+                            tokens[:, :start_pos], 0, cache,
+                            **self._play_outputs(color, legal)
+                        )
+                    self.model(
+                        tokens[:, :seqlen], start_pos, cache,
+                        **self._play_outputs(color, legal)
+                    )
+                if self.prefix_cache is not None:
+                    # elo analysis continuing from a cached prefix
+                    cache = self.new_cache()
+                    if start_pos > 0:
+                        self.model(
+                            tokens[:, :start_pos], 0, cache,
+                            elo_head=self.elo_head, elo_only=True
+                        )
+                    self.model(
+                        tokens[:, :seqlen], start_pos, cache,
+                        elo_head=self.elo_head, elo_only=True
+                    )
+                for bsz in range(1, 3):
+                    # predict_batch: start positions are a tensor
+                    caches = [self.new_cache() for _ in range(bsz)]
+                    for cache in caches:
+                        if start_pos > 0:
+                            self.model(
+                                tokens[:, :start_pos], 0, cache,
+                                **self._play_outputs(0, legal)
+                            )
+                    batch = BatchKVCache(caches, [seqlen] * bsz)
+                    outputs = self._play_outputs(None, legal)
+                    outputs["early_exit"] = None
+                    self.model(
+                        tokens[:, :seqlen].repeat(bsz, 1), batch.start_pos, batch,
+                        **outputs
+                    )
+
+    def _play_outputs(self, color: int | None, legal: torch.Tensor | None = None) -> dict:
+        return {
+            "move_head": (*self.move_head, color),
+            "elo_head": self.elo_head,
+            "last_n": self.last_n,
+            "rows": legal,
+            "early_exit": self.early_exit,
+        }
+
+    def _fit_window(self, cache: KVCache, seqlen: int) -> None:
+        """Evict the oldest tokens of a cache so that `seqlen` more fit in the window."""
+        over = cache.seqlen + seqlen - self.window
+        if over > 0:
+            # evict at least evict_size at a time to spread the cost of moving
+            # the remaining keys/values over several moves
+            n = min(max(over, self.evict_size), cache.seqlen - 1)
+            with torch.inference_mode():
+                cache.evict(n, self.freqs_cis)
+
+    def _window_tokens(self, inp: torch.Tensor) -> torch.Tensor:
+        # the uncached equivalent of the window: the start token and the most
+        # recent moves
+        if inp.shape[1] <= self.window:
+            return inp
+        return torch.cat([inp[:, :1], inp[:, 1 - self.window :]], dim=1)
+
+    def elo_analysis(self, inp: torch.Tensor) -> torch.Tensor:
+        """The elo head outputs of every position of a game."""
+        if not self.model.supports_cache:
+            _, elo_pred = self.model(inp, elo_head=self.elo_head, elo_only=True)
+            return elo_pred
+        if inp.shape[1] > self.window:
+            return self._chunked_elo_analysis(inp)
+        if self.prefix_cache is None:
+            _, elo_pred = self.model(inp, elo_head=self.elo_head, elo_only=True)
+            return elo_pred
+
+        cache = self.new_cache()
+        prefix = self.prefix_cache.extend(cache, inp, with_elo=True)
+        start_pos = cache.seqlen
+        _, elo_pred = self.model(
+            inp[:, start_pos:], start_pos, cache, elo_head=self.elo_head, elo_only=True
+        )
+        if prefix is not None:
+            elo_pred = torch.cat([prefix, elo_pred], dim=1)
+        self.prefix_cache.insert(cache, inp, elo_pred)
+        return elo_pred
+
+    def _chunked_elo_analysis(self, inp: torch.Tensor) -> torch.Tensor:
+        # feed a game longer than the window in chunks, evicting as it goes,
+        # exactly as the tokens of a long game are fed during play
+        cache = self.new_cache()
+        chunk = self.window // 2
+        elo_preds = []
+        for start in range(0, inp.shape[1], chunk):
+            tokens = inp[:, start : start + chunk]
+            self._fit_window(cache, tokens.shape[1])
+            _, elo_pred = self.model(
+                tokens, cache.seqlen, cache, elo_head=self.elo_head, elo_only=True
+            )
+            elo_preds.append(elo_pred)
+        return torch.cat(elo_preds, dim=1)
+
+    def new_cache(self) -> KVCache | None:
+        if not self.model.supports_cache:
+            return None
+        # the cache is only ever written inside Wrapper.forward
+        with torch.inference_mode():
+            return KVCache(self.model_args)
+
     def create_elo_analysis(self, elo_preds):
         wm, ws = self.whiten_params
         ms = torch.cat(
@@ -203,9 +669,11 @@ class MimicBotCore:
         )
         return ms, ss
 
-    def _create_elo_info(self, elo_pred):
+    def _create_elo_info(self, elo_pred, seqlen):
+        # elo_pred may only cover the trailing positions of a cached game, so
+        # the white/black parity comes from the full sequence length
         ms, ss = self.create_elo_analysis(elo_pred)
-        if len(ms) % 2 == 0:
+        if seqlen % 2 == 0:
             widx = -2
             bidx = -1
         else:
@@ -217,37 +685,243 @@ class MimicBotCore:
             "beloParams": {"m": ms[bidx].item(), "s": ss[bidx].item()},
         }
 
-    def predict(
+    def _push_move(
         self, uci: str | None, state: BoardState, inp: torch.Tensor
-    ) -> tuple[chess.Move, dict, torch.Tensor]:
+    ) -> torch.Tensor:
         if uci is not None:
             mvid = state.uci_to_mvid(uci)
             state.update(mvid)
             inp = add_move(mvid, inp)
+        return inp
 
-        color = inp.shape[1] % 2
-        mv_pred, elo_pred = self.model(inp)
+    def _legal_mvids(self, state: BoardState, board: chess.Board) -> torch.Tensor:
+        """The sorted vocabulary ids of every legal move in the current position."""
+        mvids = {state.uci_to_mvid(move.uci()) for move in board.legal_moves}
+        return torch.tensor(sorted(mvids), dtype=torch.long)
 
+    def _prediction(
+        self,
+        uci: str | None,
+        inp: torch.Tensor,
+        logits: torch.Tensor,
+        legal: torch.Tensor,
+        elo_pred: torch.Tensor,
+    ) -> Prediction:
+        """
+        Turn the model outputs for a position into the distribution moves are
+        sampled from, and cache it.
+
+        :param logits: The move logits of the legal moves only.
+        :param legal: The vocabulary ids the logits belong to.
+        """
         if uci is not None:
-            info = self._create_elo_info(elo_pred)
+            info = self._create_elo_info(elo_pred, inp.shape[1])
         else:
             info = self.default_elo
 
-        probs, mvids = mv_pred[0, -1, -1, -
-                               1, color].softmax(dim=0).sort(descending=True)
-        p = probs[: self.top_n].double() / probs[: self.top_n].double().sum()
+        probs, idx = logits.softmax(dim=0).topk(min(self.top_n, len(legal)))
+        probs = probs.double() / probs.double().sum()
+        prediction = Prediction(probs, legal[idx], info)
+        if self.prediction_cache is not None:
+            self.prediction_cache.put(inp, prediction)
+        return prediction
+
+    def _cached_prediction(self, inp: torch.Tensor) -> Prediction | None:
+        if self.opening_table is not None:
+            prediction = self.opening_table.get(inp)
+            if prediction is not None:
+                return prediction
+        if self.prediction_cache is None:
+            return None
+        return self.prediction_cache.get(inp)
+
+    def in_opening_table(self, uci: str | None, state: BoardState, inp: torch.Tensor) -> bool:
+        """Whether the position after `uci` is answered by the opening table."""
+        if self.opening_table is None:
+            return False
+        if uci is not None:
+            inp = add_move(state.uci_to_mvid(uci), inp)
+        return self.opening_table.get(inp) is not None
+
+    def _select_move(
+        self, state: BoardState, inp: torch.Tensor, prediction: Prediction
+    ) -> tuple[chess.Move, dict, torch.Tensor]:
+        p = prediction.probs.clone()
         p[p < self.p_thresh] = 1e-8
-        p = p / p.sum()
-        mvids = np.random.choice(
-            mvids[: self.top_n], size=self.top_n, replace=False, p=p
-        )
-        for mvid in mvids:
-            try:
-                mv = state.update(mvid)
-                inp = add_move(mvid, inp)
-                break
-            except IllegalMoveException:
-                continue
+        mvid = prediction.mvids[torch.multinomial(p, 1)].item()
+        mv = state.update(mvid)
+        inp = add_move(mvid, inp)
+        return mv, prediction.info, inp
+
+    def play_prediction(
+        self, uci: str | None, state: BoardState, inp: torch.Tensor, prediction: Prediction
+    ) -> tuple[chess.Move, dict, torch.Tensor]:
+        """Like `predict`, with the distribution for the position after `uci` already known."""
+        inp = self._push_move(uci, state, inp)
+        return self._select_move(state, inp, prediction)
+
+    def predict_replies(
+        self,
+        board: chess.Board,
+        inp: torch.Tensor,
+        cache: KVCache,
+        top_k: int,
+        stop: threading.Event | None = None,
+    ) -> dict[tuple, Prediction]:
+        """
+        Predict the opponent's `top_k` likeliest replies and the bot's move
+        distribution after each of them.
+
+        :param board: The position after the bot's move; `inp` includes it.
+        :param cache: The game's cache. Everything written to it is discarded
+            again, so that on a miss `predict` feeds the bot's move along with
+            the reply and gets the elo outputs of both.
+        :param stop: Set to give up on the remaining replies.
+        :return: The predictions, keyed by the tokens of the game after each reply.
+        """
+        state = board_state(board)
+        replies = {state.uci_to_mvid(move.uci()): move for move in board.legal_moves}
+        if len(replies) == 0 or (stop is not None and stop.is_set()):
+            return {}
+        # leave room for the reply token too
+        self._fit_window(cache, inp.shape[1] - cache.ntokens + 1)
+        legal = torch.tensor(sorted(replies), dtype=torch.long)
+        start = cache.seqlen
+        try:
+            outputs = self._play_outputs(inp.shape[1] % 2, legal)
+            # the replies are fed after the bot's move, so it has to be cached
+            outputs["early_exit"] = None
+            mv_pred, bot_elo = self.model(
+                inp[:, cache.ntokens :], cache.seqlen, cache, **outputs
+            )
+            _, idx = mv_pred[0, -1].topk(min(top_k, len(legal)))
+            # the elo estimates of a reply also need the position of the bot's move
+            bot_elo = bot_elo[:, -1:]
+
+            predictions = {}
+            for mvid in legal[idx].tolist():
+                if stop is not None and stop.is_set():
+                    break
+                after = board.copy()
+                after.push(replies[mvid])
+                reply_legal = self._legal_mvids(board_state(after), after)
+                if len(reply_legal) == 0:
+                    continue
+                reply_inp = add_move(mvid, inp)
+                seqlen = cache.seqlen
+                mv_pred, elo_pred = self.model(
+                    reply_inp[:, -1:], seqlen, cache,
+                    **self._play_outputs(reply_inp.shape[1] % 2, reply_legal)
+                )
+                cache.truncate(seqlen)
+                predictions[tuple(reply_inp[0].tolist())] = self._prediction(
+                    replies[mvid].uci(),
+                    reply_inp,
+                    mv_pred[0, -1],
+                    reply_legal,
+                    torch.cat([bot_elo, elo_pred], dim=1),
+                )
+            return predictions
+        finally:
+            cache.truncate(start)
+
+    def predict(
+        self,
+        uci: str | None,
+        state: BoardState,
+        board: chess.Board,
+        inp: torch.Tensor,
+        cache: KVCache | None = None,
+    ) -> tuple[chess.Move, dict, torch.Tensor]:
+        """
+        :param board: The position after `uci`; only the logits of its legal
+            moves are computed.
+        """
+        inp = self._push_move(uci, state, inp)
+        prediction = self._cached_prediction(inp)
+        if prediction is not None:
+            # the KV cache catches up on the skipped tokens at the next miss
+            return self._select_move(state, inp, prediction)
+
+        legal = self._legal_mvids(state, board)
+        color = inp.shape[1] % 2
+        outputs = self._play_outputs(color, legal)
+        if cache is None:
+            mv_pred, elo_pred = self.model(self._window_tokens(inp), **outputs)
         else:
-            raise Exception("model did not produce a legal move")
-        return mv, info, inp
+            if self.prefix_cache is not None:
+                self.prefix_cache.extend(cache, inp, keep=self.last_n)
+            # only the tokens added since the last call need to be processed
+            self._fit_window(cache, inp.shape[1] - cache.ntokens)
+            mv_pred, elo_pred = self.model(
+                inp[:, cache.ntokens :], cache.seqlen, cache, **outputs
+            )
+            if self.prefix_cache is not None:
+                self.prefix_cache.insert(cache, inp)
+
+        prediction = self._prediction(uci, inp, mv_pred[0, -1], legal, elo_pred)
+        return self._select_move(state, inp, prediction)
+
+    def predict_batch(self, requests: list[tuple]) -> list:
+        """
+        Run `predict` for several games with a single forward pass.
+
+        :param requests: `(uci, state, board, inp, cache)` tuples, as passed to `predict`.
+        :return: For each request, either the result of `predict` or the exception it raised.
+        """
+        results = [None] * len(requests)
+        rows = []
+        for i, (uci, state, board, inp, cache) in enumerate(requests):
+            try:
+                if cache is None:
+                    results[i] = self.predict(uci, state, board, inp)
+                    continue
+                inp = self._push_move(uci, state, inp)
+                prediction = self._cached_prediction(inp)
+                if prediction is not None:
+                    results[i] = self._select_move(state, inp, prediction)
+                else:
+                    rows.append((i, inp, self._legal_mvids(state, board)))
+            except Exception as e:
+                results[i] = e
+        if len(rows) == 0:
+            return results
+
+        caches = [requests[i][4] for i, _, _ in rows]
+        if self.prefix_cache is not None:
+            for (_, inp, _), cache in zip(rows, caches):
+                self.prefix_cache.extend(cache, inp, keep=self.last_n)
+        seqlens = []
+        for (_, inp, _), cache in zip(rows, caches):
+            seqlens.append(inp.shape[1] - cache.ntokens)
+            self._fit_window(cache, seqlens[-1])
+        batch = BatchKVCache(caches, seqlens)
+        tokens = torch.zeros((len(rows), batch.width), dtype=torch.int32)
+        for j, ((_, inp, _), n) in enumerate(zip(rows, seqlens)):
+            tokens[j, batch.width - n :] = inp[0, inp.shape[1] - n :]
+        # every game's legal moves are columns of the shared projection
+        union = torch.unique(torch.cat([legal for _, _, legal in rows]))
+        outputs = self._play_outputs(None, union)
+        # the exit test would read the union of the games' moves and both
+        # colours, not each game's own distribution
+        outputs["early_exit"] = None
+        mv_pred, elo_pred = self.model(tokens, batch.start_pos, batch, **outputs)
+        if self.prefix_cache is not None:
+            for (_, inp, _), cache in zip(rows, caches):
+                self.prefix_cache.insert(cache, inp)
+
+        for j, ((i, inp, legal), n) in enumerate(zip(rows, seqlens)):
+            uci, state = requests[i][:2]
+            color = inp.shape[1] % 2
+            try:
+                prediction = self._prediction(
+                    uci,
+                    inp,
+                    mv_pred[j, -1, color, torch.searchsorted(union, legal)],
+                    legal,
+                    elo_pred[j : j + 1, -min(n, self.last_n) :],
+                )
+                results[i] = self._select_move(state, inp, prediction)
+            except Exception as e:
+                results[i] = e
+        return results
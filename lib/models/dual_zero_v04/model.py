@@ -1,7 +1,6 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed in accordance with the terms of the Llama 3 Community License Agreement.
 
-import math
 from dataclasses import dataclass
 from typing import Optional, Tuple
 
@@ -43,9 +42,40 @@ class RMSNorm(torch.nn.Module):
 
     def forward(self, x):
         output = self._norm(x.float()).type_as(x)
+        if self.weight is None:
+            # folded into the layer that follows by fuse_linear
+            return output
         return output * self.weight
 
 
+def fuse_linear(linears, norm: Optional[RMSNorm] = None) -> nn.Linear:
+    """
+    One Linear layer computing the concatenated outputs of `linears`. The
+    weight of the RMSNorm applied to their input is folded into it.
+    """
+    weight = torch.cat([linear.weight for linear in linears])
+    if norm is not None:
+        weight = weight * norm.weight
+        norm.weight = None
+    fused = nn.Linear(weight.shape[1], weight.shape[0], bias=False,
+                      device="meta")
+    fused.weight = nn.Parameter(weight, requires_grad=False)
+    return fused
+
+
+def project_rows(linear, x: torch.Tensor, rows) -> torch.Tensor:
+    """Only the output features `rows` of a Linear layer."""
+    if isinstance(linear, nn.Linear):
+        return F.linear(x, linear.weight[rows])
+    # e.g. a quantized layer, whose weight cannot be sliced
+    return linear(x)[..., rows]
+
+
+def fold_head(head) -> torch.Tensor:
+    """The output weight of a MoveHead/EloHead with its norm folded in."""
+    return head.output.weight * head.norm.weight
+
+
 def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
     freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
     t = torch.arange(end, device=freqs.device, dtype=torch.float32)
@@ -57,6 +87,10 @@ def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
 def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     ndim = x.ndim
     assert 0 <= 1 < ndim
+    if freqs_cis.ndim == 3:
+        # one row of positions per batch element
+        assert freqs_cis.shape == (x.shape[0], x.shape[1], x.shape[-1])
+        return freqs_cis[:, :, None, :]
     assert freqs_cis.shape == (x.shape[1], x.shape[-1])
     shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
     return freqs_cis.view(*shape)
@@ -67,6 +101,8 @@ def apply_rotary_emb(
     xk: torch.Tensor,
     freqs_cis: torch.Tensor,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
+    if not freqs_cis.is_complex():
+        return apply_rotary_emb_real(xq, xk, freqs_cis)
     xq_ = torch.view_as_complex(xq.float().reshape(*xq.shape[:-1], -1, 2))
     xk_ = torch.view_as_complex(xk.float().reshape(*xk.shape[:-1], -1, 2))
     freqs_cis = reshape_for_broadcast(freqs_cis, xq_)
@@ -75,6 +111,27 @@ def apply_rotary_emb(
     return xq_out.type_as(xq), xk_out.type_as(xk)
 
 
+def apply_rotary_emb_real(
+    xq: torch.Tensor,
+    xk: torch.Tensor,
+    freqs: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # same rotation as apply_rotary_emb without complex tensors (e.g. for
+    # ONNX export); freqs is torch.view_as_real(freqs_cis)
+    xq_ = xq.float().reshape(*xq.shape[:-1], -1, 2)
+    xk_ = xk.float().reshape(*xk.shape[:-1], -1, 2)
+    cos = reshape_for_broadcast(freqs[..., 0], xq_[..., 0])
+    sin = reshape_for_broadcast(freqs[..., 1], xq_[..., 0])
+
+    def rotate(x):
+        re, im = x[..., 0], x[..., 1]
+        return torch.stack([re * cos - im * sin, re * sin + im * cos], dim=-1)
+
+    xq_out = rotate(xq_).flatten(3)
+    xk_out = rotate(xk_).flatten(3)
+    return xq_out.type_as(xq), xk_out.type_as(xk)
+
+
 def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     """torch.repeat_interleave(x, dim=2, repeats=n_rep)"""
     bs, slen, n_kv_heads, head_dim = x.shape
@@ -117,6 +174,12 @@ class Attention(nn.Module):
             args.dim,
             bias=False,
         )
+        self.wqkv = None
+
+    def fuse(self, norm: RMSNorm):
+        """Merge wq/wk/wv into a single projection."""
+        self.wqkv = fuse_linear([self.wq, self.wk, self.wv], norm)
+        del self.wq, self.wk, self.wv
 
     def forward(
         self,
@@ -124,9 +187,15 @@ class Attention(nn.Module):
         start_pos: int,
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
+        cache=None,
     ):
         bsz, seqlen, _ = x.shape
-        xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
+        if self.wqkv is not None:
+            kvdim = self.n_local_kv_heads * self.head_dim
+            xq, xk, xv = self.wqkv(x).split(
+                [self.n_local_heads * self.head_dim, kvdim, kvdim], dim=-1)
+        else:
+            xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
 
         xq = xq.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         xk = xk.view(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
@@ -134,27 +203,33 @@ class Attention(nn.Module):
 
         xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
 
-        keys = xk
-        values = xv
+        if cache is not None:
+            keys, values = cache.update(start_pos, xk, xv)
+        else:
+            keys = xk
+            values = xv
 
-        # repeat k/v heads if n_kv_heads < n_heads
-        keys = repeat_kv(
-            keys, self.n_rep
-        )  # (bs, cache_len + seqlen, n_local_heads, head_dim)
-        values = repeat_kv(
-            values, self.n_rep
-        )  # (bs, cache_len + seqlen, n_local_heads, head_dim)
+        # the fused kernel shares each k/v head across its n_rep query heads;
+        # the onnx exporter does not support that, so repeat them there
+        gqa = self.n_rep > 1 and not torch.onnx.is_in_onnx_export()
+        if not gqa:
+            keys = repeat_kv(keys, self.n_rep)
+            values = repeat_kv(values, self.n_rep)
 
         xq = xq.transpose(1, 2)  # (bs, n_local_heads, seqlen, head_dim)
-        keys = keys.transpose(1, 2)  # (bs, n_local_heads, cache_len + seqlen, head_dim)
-        values = values.transpose(
-            1, 2
-        )  # (bs, n_local_heads, cache_len + seqlen, head_dim)
-        scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(self.head_dim)
-        if mask is not None:
-            scores = scores + mask  # (bs, n_local_heads, seqlen, cache_len + seqlen)
-        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-        output = torch.matmul(scores, values)  # (bs, n_local_heads, seqlen, head_dim)
+        # (bs, n_kv_heads, cache_len + seqlen, head_dim)
+        keys = keys.transpose(1, 2)
+        values = values.transpose(1, 2)
+        # without a mask, a multi-token input has no cached prefix and is
+        # plainly causal
+        output = F.scaled_dot_product_attention(
+            xq,
+            keys,
+            values,
+            attn_mask=mask,
+            is_causal=mask is None and seqlen > 1,
+            enable_gqa=gqa,
+        )  # (bs, n_local_heads, seqlen, head_dim)
         output = output.transpose(1, 2).contiguous().view(bsz, seqlen, -1)
         return self.wo(output)
 
@@ -177,8 +252,17 @@ class FeedForward(nn.Module):
         self.w1 = nn.Linear(dim, hidden_dim, bias=False)
         self.w2 = nn.Linear(hidden_dim, dim, bias=False)
         self.w3 = nn.Linear(dim, hidden_dim, bias=False)
+        self.w13 = None
+
+    def fuse(self, norm: RMSNorm):
+        """Merge the w1/w3 gate and up projections."""
+        self.w13 = fuse_linear([self.w1, self.w3], norm)
+        del self.w1, self.w3
 
     def forward(self, x):
+        if self.w13 is not None:
+            x1, x3 = self.w13(x).chunk(2, dim=-1)
+            return self.w2(F.silu(x1) * x3)
         return self.w2(F.silu(self.w1(x)) * self.w3(x))
 
 
@@ -197,14 +281,22 @@ class TransformerBlock(nn.Module):
         self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
         self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
 
+    def fuse(self):
+        self.attention.fuse(self.attention_norm)
+        self.feed_forward.fuse(self.ffn_norm)
+
     def forward(
         self,
         x: torch.Tensor,
         start_pos: int,
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
+        cache=None,
     ):
-        h = x + self.attention(self.attention_norm(x), start_pos, freqs_cis, mask)
+        layer_cache = None if cache is None else cache[self.layer_id]
+        h = x + self.attention(
+            self.attention_norm(x), start_pos, freqs_cis, mask, layer_cache
+        )
         out = h + self.feed_forward(self.ffn_norm(h))
         return out
 
@@ -230,7 +322,9 @@ class MoveHead(nn.Module):
         self.norm = RMSNorm(params.dim, eps=params.norm_eps)
         self.output = nn.Linear(params.dim, params.vocab_size, bias=False)
 
-    def forward(self, h: torch.Tensor):
+    def forward(self, h: torch.Tensor, rows=None):
+        if rows is not None:
+            return project_rows(self.output, self.norm(h), rows).float()
         return self.output(self.norm(h)).float()
 
 
@@ -269,14 +363,79 @@ class Transformer(nn.Module):
             params.max_seq_len * 2,
             params.rope_theta,
         )
+        self.causal_mask = None
+        self.head_norm = None
+        self.elo_weight = None
+        self.move_weight = None
+        # number of layers run by the last forward
+        self.exit_depth = params.n_layers
+
+    def build_causal_mask(self, device):
+        """
+        Build the mask for the longest sequence, which calls slice. Called
+        before torch.compile, the compiled forward only reads the tensor.
+        """
+        n = self.freqs_cis.shape[0]
+        self.causal_mask = torch.ones(
+            (n, n), dtype=torch.bool, device=device).tril()
+
+    def _causal_mask(self, device):
+        if self.causal_mask is None or self.causal_mask.device != device:
+            self.build_causal_mask(device)
+        return self.causal_mask
+
+    def fuse_weights(self):
+        """
+        Merge weights for inference, after the checkpoint is loaded: the
+        attention and gate/up projections of every block, the RMSNorm
+        weights into the layers that follow them, and the per-head move/elo
+        weights into stacked tensors evaluated in one call.
+        """
+        for layer in self.layers:
+            layer.fuse()
+        self.preproc = fuse_linear([self.preproc], self.norm)
+        # each head normalizes the same timecontrol slice, so only their
+        # norm weights differ and those are folded into the outputs
+        self.head_norm = RMSNorm(self.params.dim, eps=self.params.norm_eps)
+        self.head_norm.weight = None
+        if self.params.elo_pred_size > 0:
+            # (timecontrol, elo_pred_size, dim)
+            self.elo_weight = nn.Parameter(torch.stack(
+                [fold_head(head) for head in self.elo_heads]
+            ), requires_grad=False)
+            del self.elo_heads
+        if self.params.predict_move:
+            # (timecontrol, elo, vocab, dim)
+            self.move_weight = nn.Parameter(torch.stack([
+                torch.stack([fold_head(head) for head in tc_heads])
+                for tc_heads in self.move_heads
+            ]), requires_grad=False)
+            del self.move_heads
 
     def _reshape_timecontrol(self, h):
         bs, seqlen, dim = h.shape
         h = h.reshape(bs, seqlen, self.params.n_timecontrol_heads, -1)
         return h
 
-    def _get_elo_pred(self, h: torch.Tensor):
+    def _get_fused_elo_pred(self, h: torch.Tensor, elo_head=None):
+        h = self.head_norm(h)
+        if elo_head is not None:
+            out = F.linear(h[:, :, elo_head], self.elo_weight[elo_head])
+            out = out[:, :, None].float()
+        else:
+            out = torch.einsum("bstd,tkd->bstk", h, self.elo_weight).float()
+        if self.params.gaussian_elo:
+            # make sure variance is non-negative
+            out[..., 1] = torch.exp(out[..., 1])
+        return out
+
+    def _get_elo_pred(self, h: torch.Tensor, elo_head=None):
         if self.params.elo_pred_size > 0:
+            if self.elo_weight is not None:
+                return self._get_fused_elo_pred(h, elo_head)
+            if elo_head is not None:
+                # only the requested time control head, keeping its axis
+                return self.elo_heads[elo_head](h[:, :, elo_head])[:, :, None]
             h_outs = []
             for i in range(self.params.n_timecontrol_heads):
                 h_out = self.elo_heads[i](h[:, :, i])
@@ -285,8 +444,26 @@ class Transformer(nn.Module):
         else:
             return None
 
-    def _get_move_pred(self, h: torch.Tensor):
+    def _get_fused_move_pred(self, h: torch.Tensor, move_head=None,
+                             rows=None):
+        h = self.head_norm(h)
+        if move_head is not None:
+            tc, elo, _ = move_head
+            weight = self.move_weight[tc, elo]
+            if rows is not None:
+                weight = weight[rows]
+            return F.linear(h[:, :, tc], weight).float()
+        return torch.einsum("bstd,tevd->bstev", h, self.move_weight).float()
+
+    def _get_move_pred(self, h: torch.Tensor, move_head=None, rows=None):
         if self.params.predict_move:
+            if self.move_weight is not None:
+                return self._get_fused_move_pred(h, move_head, rows)
+            if move_head is not None:
+                # only the requested (timecontrol, elo, color) head; both
+                # colors share the same head in this model
+                tc, elo, _ = move_head
+                return self.move_heads[tc][elo](h[:, :, tc], rows)
             tc_outs = []
             for i in range(self.params.n_timecontrol_heads):
                 elo_outs = []
@@ -298,22 +475,92 @@ class Transformer(nn.Module):
         else:
             return None
 
-    def forward(self, tokens: torch.Tensor, start_pos: int = 0):
-        _bsz, seqlen = tokens.shape
+    @staticmethod
+    def _confident(mv_pred: torch.Tensor, min_top1=None, max_entropy=None):
+        # every row's move distribution at its last position must be sharp
+        probs = mv_pred[:, -1].softmax(dim=-1)
+        if min_top1 is not None and probs.max(dim=-1).values.min() < min_top1:
+            return False
+        if max_entropy is not None:
+            entropy = torch.special.entr(probs).sum(dim=-1)
+            if entropy.max() > max_entropy:
+                return False
+        return True
+
+    def _outputs(
+        self, h, move_head=None, elo_head=None, last_n=None, elo_only=False, rows=None
+    ):
+        if last_n is not None:
+            # the output heads only need the trailing positions
+            h = h[:, -last_n:]
+        h = self.norm(h)
+
+        h = F.silu(self.preproc(h))
+        h = self._reshape_timecontrol(h)
+        if elo_only:
+            return None, self._get_elo_pred(h, elo_head)
+        return (
+            self._get_move_pred(h, move_head, rows),
+            self._get_elo_pred(h, elo_head),
+        )
+
+    def forward(
+        self,
+        tokens: torch.Tensor,
+        start_pos: int = 0,
+        cache=None,
+        move_head=None,
+        elo_head=None,
+        last_n=None,
+        elo_only=False,
+        rows=None,
+        early_exit=None,
+    ):
+        """
+        :param early_exit: `(layers, min_top1, max_entropy)`. After each of
+            `layers` (counted from 1), the move head is evaluated and its outputs
+            are returned if the distribution at the last position of every row
+            has a top-1 probability of at least `min_top1` and an entropy of at
+            most `max_entropy` (either may be None). A cache is not advanced
+            past the tokens of an exited call, so it only ever holds keys/values
+            computed by every layer. Only used with `move_head`.
+        """
+        bsz, seqlen = tokens.shape
         h = self.tok_embeddings(tokens)
 
         self.freqs_cis = self.freqs_cis.to(h.device)
-        freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
 
         mask = None
-        if seqlen > 1:
-            mask = torch.full((seqlen, seqlen), float("-inf"), device=tokens.device)
-            mask = torch.triu(mask, diagonal=1)
-
-        for layer in self.layers:
-            h = layer(h, start_pos, freqs_cis, mask)
-        h = self.norm(h)
-
-        h = F.silu(self.preproc(h))
-        h = self._reshape_timecontrol(h)
-        return self._get_move_pred(h), self._get_elo_pred(h)
+        if isinstance(start_pos, torch.Tensor):
+            # left-padded batch over a BatchKVCache: start_pos holds the
+            # position of the first column of each row
+            positions = start_pos[:, None] + torch.arange(seqlen, device=tokens.device)
+            positions = positions.clamp(min=0)
+            freqs_cis = self.freqs_cis[positions]
+            keypos = torch.arange(int(positions.max()) + 1, device=tokens.device)
+            mask = keypos <= positions[:, None, :, None]
+        else:
+            freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
+            if seqlen > 1 and cache is not None:
+                # new tokens attend to every cached position
+                mask = self._causal_mask(tokens.device)[
+                    start_pos : start_pos + seqlen, : start_pos + seqlen
+                ]
+
+        exit_layers, min_top1, max_entropy = early_exit or ((), None, None)
+        if move_head is None or elo_only:
+            exit_layers = ()
+        self.exit_depth = self.n_layers
+        for depth, layer in enumerate(self.layers, 1):
+            h = layer(h, start_pos, freqs_cis, mask, cache)
+            if depth in exit_layers and depth < self.n_layers:
+                outputs = self._outputs(h, move_head, elo_head, last_n, elo_only, rows)
+                if self._confident(outputs[0], min_top1, max_entropy):
+                    self.exit_depth = depth
+                    # the skipped layers have no keys/values for these
+                    # tokens, so the cache is not advanced and the next call
+                    # feeds them again
+                    return outputs
+        if cache is not None:
+            cache.advance(seqlen)
+        return self._outputs(h, move_head, elo_head, last_n, elo_only, rows)
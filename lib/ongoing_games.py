@@ -0,0 +1,135 @@
+"""The bot's ongoing games, cached for every worker process on the host."""
+
+import json
+import time
+
+from lib.shared_store import SharedStore
+
+# local start/finish events are kept this long, to be replayed over lists
+# fetched before they happened
+EVENT_RETENTION = 60
+
+
+class OngoingGames:
+    """
+    A short-lived copy of lichess's list of the bot's ongoing games, stored in
+    a `SharedStore`.
+
+    Once the list is older than `ttl_s`, one caller across all processes
+    refreshes it while the others keep returning the stale list. Games that
+    this host starts or finishes are applied to the list right away and
+    replayed over any refresh that was fetched before them. The store opens
+    its connection in each process that uses it, so `main.py` can create
+    this before celery forks its workers.
+    """
+
+    def __init__(
+        self,
+        fetch,
+        path: str = "/tmp/mimicbot_ongoing_games.db",
+        ttl_s: float = 3,
+        refresh_timeout_s: float = 10,
+    ) -> None:
+        """
+        :param fetch: Gets the list from lichess, e.g. `Lichess.fetch_ongoing_games`.
+        :param path: The sqlite file shared by the processes.
+        :param ttl_s: How long a fetched list is used before it is refreshed.
+        :param refresh_timeout_s: How long a refresh may take before another caller
+            takes it over.
+        """
+        self.fetch = fetch
+        self.ttl = ttl_s
+        self.refresh_timeout = refresh_timeout_s
+        self.store = SharedStore(path, "ongoing_games")
+
+    def get(self) -> list[dict]:
+        """The ongoing games, refreshed from lichess if the list has expired."""
+        while True:
+            now = time.time()
+            state = self._load(self.store.get("state"))
+            if state["games"] is not None and now - state["time"] <= self.ttl:
+                return state["games"]
+            if now <= state["refreshing"]:
+                games, refresh = state["games"], False
+            else:
+                # only take the write lock to claim an expired list's refresh
+                games, refresh = self.store.update(
+                    "state", lambda state: self._claim_refresh(state, now)
+                )
+            if refresh:
+                try:
+                    return self._refresh(now)
+                except Exception:
+                    if games is None:
+                        raise
+                    return games
+            if games is not None:
+                return games
+            # another caller is fetching the very first list
+            time.sleep(0.05)
+
+    def add(self, game_id: str) -> None:
+        """Record a game this host started."""
+        self._record(game_id, "add")
+
+    def remove(self, game_id: str) -> None:
+        """Record a game this host finished."""
+        self._record(game_id, "remove")
+
+    def _load(self, state: str | None) -> dict:
+        if state is None:
+            return {"time": 0, "games": None, "refreshing": 0, "events": {}}
+        return json.loads(state)
+
+    def _claim_refresh(self, state: str | None, now: float):
+        state = self._load(state)
+        refresh = now - state["time"] > self.ttl and now > state["refreshing"]
+        if refresh:
+            state["refreshing"] = now + self.refresh_timeout
+        return json.dumps(state), (state["games"], refresh)
+
+    def _refresh(self, started: float) -> list[dict]:
+        try:
+            games = self.fetch()
+        except Exception:
+            # let the next caller try again
+            self.store.update("state", lambda state: self._release(state))
+            raise
+
+        def store(state):
+            state = self._load(state)
+            events = {
+                game_id: event
+                for game_id, event in state["events"].items()
+                if event[0] > time.time() - EVENT_RETENTION
+            }
+            fresh = list(games)
+            for game_id, (at, kind) in sorted(events.items(), key=lambda e: e[1][0]):
+                if at > started:
+                    fresh = self._apply(fresh, game_id, kind)
+            state.update(time=started, games=fresh, refreshing=0, events=events)
+            return json.dumps(state), fresh
+
+        return self.store.update("state", store)
+
+    def _release(self, state: str | None):
+        state = self._load(state)
+        state["refreshing"] = 0
+        return json.dumps(state), None
+
+    def _record(self, game_id: str, kind: str) -> None:
+        def record(state):
+            state = self._load(state)
+            state["events"][game_id] = [time.time(), kind]
+            if state["games"] is not None:
+                state["games"] = self._apply(state["games"], game_id, kind)
+            return json.dumps(state), None
+
+        self.store.update("state", record)
+
+    @staticmethod
+    def _apply(games: list[dict], game_id: str, kind: str) -> list[dict]:
+        games = [game for game in games if game["gameId"] != game_id]
+        if kind == "add":
+            games.append({"gameId": game_id})
+        return games
@@ -0,0 +1,122 @@
+"""Precomputed predictions for common openings, memory-mapped from disk."""
+
+import hashlib
+import os
+import struct
+
+import numpy as np
+import torch
+
+from lib.prediction_cache import Prediction
+
+MAGIC = b"MIMICOT\0"
+VERSION = 1
+# magic, version, top_n, model id, number of entries
+HEADER = struct.Struct("<8sII32sQ")
+
+
+def prefix_hash(tokens) -> int:
+    """A 64 bit key for the tokens of a game so far."""
+    data = np.asarray(tokens, dtype=np.int16).tobytes()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def _layout(count: int, top_n: int) -> list[tuple[str, np.dtype, tuple, int]]:
+    # (name, dtype, shape, offset) of each array, 8-byte aligned after the header
+    arrays = [
+        ("hashes", np.dtype(np.uint64), (count,)),
+        ("probs", np.dtype(np.float32), (count, top_n)),
+        ("mvids", np.dtype(np.int16), (count, top_n)),
+        ("elos", np.dtype(np.float32), (count, 4)),
+    ]
+    layout = []
+    offset = HEADER.size
+    for name, dtype, shape in arrays:
+        offset = (offset + 7) // 8 * 8
+        layout.append((name, dtype, shape, offset))
+        offset += dtype.itemsize * int(np.prod(shape))
+    return layout
+
+
+def write_table(path: str, model_id: str, top_n: int, entries: dict) -> None:
+    """
+    Write an opening table.
+
+    :param entries: The `Prediction` of each token prefix, keyed by the
+        prefix tokens.
+    """
+    items = sorted((prefix_hash(tokens), prediction) for tokens, prediction in entries.items())
+    count = len(items)
+    arrays = {
+        "hashes": np.array([h for h, _ in items], dtype=np.uint64),
+        "probs": np.zeros((count, top_n), dtype=np.float32),
+        "mvids": np.full((count, top_n), -1, dtype=np.int16),
+        "elos": np.zeros((count, 4), dtype=np.float32),
+    }
+    for i, (_, prediction) in enumerate(items):
+        n = len(prediction.mvids)
+        arrays["probs"][i, :n] = prediction.probs.numpy()
+        arrays["mvids"][i, :n] = prediction.mvids.numpy()
+        info = prediction.info
+        arrays["elos"][i] = [
+            info["weloParams"]["m"],
+            info["weloParams"]["s"],
+            info["beloParams"]["m"],
+            info["beloParams"]["s"],
+        ]
+
+    # running workers may have the old table mapped, so replace the file
+    # rather than overwrite it
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, top_n, model_id.encode(), count))
+        for name, _, _, offset in _layout(count, top_n):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(arrays[name].tobytes())
+    os.replace(tmp, path)
+
+
+class OpeningTable:
+    """
+    A table written by build_opening_table.py.
+
+    The arrays are memory-mapped, so workers share one copy through the page
+    cache and a lookup is a binary search over the sorted prefix hashes.
+    """
+
+    def __init__(self, path: str, model_id: str, default_elo: dict) -> None:
+        """
+        :param model_id: The model the table must have been built for.
+        :param default_elo: The elo info of the first position.
+        """
+        with open(path, "rb") as f:
+            magic, version, top_n, table_model, count = HEADER.unpack(f.read(HEADER.size))
+        table_model = table_model.rstrip(b"\0").decode()
+        if magic != MAGIC or version != VERSION:
+            raise Exception(f"{path} is not a version {VERSION} opening table")
+        if table_model != model_id:
+            raise Exception(f"{path} was built for {table_model}, not {model_id}")
+        self.top_n = top_n
+        self.default_elo = default_elo
+        for name, dtype, shape, offset in _layout(count, top_n):
+            setattr(self, name, np.memmap(path, dtype, "r", offset, shape))
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def get(self, inp: torch.Tensor) -> Prediction | None:
+        key = np.uint64(prefix_hash(inp[0].numpy()))
+        i = int(np.searchsorted(self.hashes, key))
+        if i == len(self.hashes) or self.hashes[i] != key:
+            return None
+        n = int((self.mvids[i] >= 0).sum())
+        if inp.shape[1] == 1:
+            info = self.default_elo
+        else:
+            wm, ws, bm, bs = self.elos[i].tolist()
+            info = {"weloParams": {"m": wm, "s": ws}, "beloParams": {"m": bm, "s": bs}}
+        return Prediction(
+            torch.from_numpy(self.probs[i, :n].astype(np.float64)),
+            torch.from_numpy(self.mvids[i, :n].astype(np.int64)),
+            info,
+        )
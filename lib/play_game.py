@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Iterator
 from requests.exceptions import (
     ChunkedEncodingError,
     HTTPError,
@@ -7,17 +7,16 @@ from requests.exceptions import (
 )
 import io
 from collections import Counter, defaultdict
+from chess.engine import PlayResult
 from chess.variant import find_variant
 from http.client import RemoteDisconnected
 from lib import model, lichess
 from lib.lichess_types import UserProfileType
-from lib.timer import to_seconds, seconds, msec
+from lib.timer import seconds, msec
 from lib.mimic import MimicBot
 from lib.pgnutils import IllegalMoveException
-import time
 import chess
 import itertools
-import copy
 import logging
 import json
 
@@ -42,14 +41,13 @@ def is_game_over(game: model.Game) -> bool:
     return status != "started"
 
 
-def game_changed(current_game: model.Game, prior_game: model.Game | None) -> bool:
-    """Check whether the current game state is different from the previous game state."""
-    if prior_game is None:
+def game_changed(current_game: model.Game, prior_moves: str | None) -> bool:
+    """Check whether the current game state has different moves from the previous game state."""
+    if prior_moves is None:
         return True
 
     current_game_moves_str = current_game.state["moves"]
-    prior_game_moves_str = prior_game.state["moves"]
-    return current_game_moves_str != prior_game_moves_str
+    return current_game_moves_str != prior_moves
 
 
 def bot_to_move(game: model.Game, board: chess.Board) -> bool:
@@ -57,10 +55,10 @@ def bot_to_move(game: model.Game, board: chess.Board) -> bool:
 
 
 def is_engine_move(
-    game: model.Game, prior_game: model.Game | None, board: chess.Board
+    game: model.Game, prior_moves: str | None, board: chess.Board
 ) -> bool:
     """Check whether it is the engine's turn."""
-    return game_changed(game, prior_game) and bot_to_move(game, board)
+    return game_changed(game, prior_moves) and bot_to_move(game, board)
 
 
 def setup_board(game: model.Game) -> chess.Board:
@@ -114,27 +112,99 @@ def analyze_pgn(pgn: io.StringIO) -> dict:
     return engine.analyze_pgn(pgn)
 
 
+def analyze_pgns(pgns: list[io.StringIO]) -> Iterator[dict]:
+    return engine.analyze_pgns(pgns)
+
+
+class GameSession:
+    """
+    The bot's side of one game, fed the updates of the game's stream by
+    `play_game` or by the asyncio runtime in `lib.game_runtime`.
+    """
+
+    def __init__(
+        self, game_id: str, li: lichess.Lichess, config, username: str, initial_state: dict
+    ) -> None:
+        self.li = li
+        self.abort_time = seconds(config.abort_time)
+        self.game = model.Game(initial_state, username, li.baseUrl, self.abort_time)
+        # the moves of the previous gameState, rather than a copy of the game
+        self.prior_moves = None
+        self.moves = self.game.state["moves"].split()
+        self.board = setup_board(self.game)
+
+        logging.getLogger(__name__).info(f"+++ {self.game}")
+        engine.add_game(game_id)
+        if li.ongoing_games is not None:
+            li.ongoing_games.add(game_id)
+
+    def update(self, upd: dict) -> bool:
+        """Apply a gameState update and return whether the engine has to move."""
+        self.game.state = upd
+        self._update_board(upd["moves"].split())
+        return not is_game_over(self.game) and is_engine_move(
+            self.game, self.prior_moves, self.board
+        )
+
+    def _update_board(self, moves: list[str]) -> None:
+        # an update usually adds a single move, which is all that gets pushed;
+        # a takeback or any other divergence rebuilds the board
+        n = len(self.moves)
+        if moves[:n] != self.moves:
+            self.board = setup_board(self.game)
+        else:
+            for move in moves[n:]:
+                try:
+                    self.board.push_uci(move)
+                except ValueError:
+                    pass
+        self.moves = moves
+
+    def play_move(self) -> PlayResult | None:
+        """Play the engine's move, or resign and return None if it has none."""
+        try:
+            return engine.play_move(self.board, self.game, self.li)
+        except IllegalMoveException:
+            self.li.resign(self.game.id)
+            return None
+
+    def ping(self, upd: dict) -> None:
+        """Push back the abort/terminate timers after a gameState update."""
+        wbtime = upd[wbtime_param(self.board)]
+        wbinc = upd[wbinc_param(self.board)]
+        terminate_time = msec(wbtime) + msec(wbinc) + seconds(60)
+        self.game.ping(self.abort_time, terminate_time)
+        self.prior_moves = self.game.state["moves"]
+
+    def should_exit(self) -> bool:
+        return should_exit_game(self.game, self.li)
+
+    def end(self) -> None:
+        engine.remove_game(self.game.id)
+        # the game's last elo record and chat must not die with the process
+        if not engine.writer.flush(self.game.id):
+            logging.getLogger(__name__).warning(
+                f"side effects of {self.game.id} still pending")
+        if self.li.ongoing_games is not None:
+            self.li.ongoing_games.remove(self.game.id)
+        tell_user_game_result(self.game, self.board)
+        logging.getLogger(__name__).info(f"--- {self.game.url()} Game over")
+
+
 def play_game(game_id: str, li: lichess.Lichess, config, username: str) -> None:
     logger = logging.getLogger(__name__)
 
     response = li.get_game_stream(game_id)
-    li.chat(game_id, "player", json.dumps(engine.default_elo()))
+    engine.writer.chat(li, game_id, "player", json.dumps(engine.default_elo()))
     lines = response.iter_lines()
 
     # Initial response of stream will be the full game info. Store it.
     initial_state = json.loads(next(lines).decode("utf-8"))
     logger.info(f"Initial state: {initial_state}")
-    abort_time = seconds(config.abort_time)
-    game = model.Game(initial_state, username, li.baseUrl, abort_time)
-
-    logger.info(f"+++ {game}")
-    engine.add_game(game_id)
-    delay = msec(config.rate_limiting_delay)
+    session = GameSession(game_id, li, config, username, initial_state)
 
-    prior_game = None
-    board = chess.Board()
     game_stream = itertools.chain(
-        [json.dumps(game.state).encode("utf-8")], lines)
+        [json.dumps(session.game.state).encode("utf-8")], lines)
     stay_in_game = True
     while stay_in_game:
         move_attempted = False
@@ -142,31 +212,16 @@ def play_game(game_id: str, li: lichess.Lichess, config, username: str) -> None:
             upd = next_update(game_stream)
             u_type = upd["type"] if upd else "ping"
             if u_type == "gameState":
-                game.state = upd
-                board = setup_board(game)
-                # logger.info(f"{game_id}:\n{board}")
-                if not is_game_over(game) and is_engine_move(game, prior_game, board):
+                if session.update(upd):
                     move_attempted = True
-                    try:
-                        move = engine.play_move(
-                            board,
-                            game,
-                            li,
-                        )
-                        li.chat(game_id, "player", json.dumps(move.info))
-                        time.sleep(to_seconds(delay))
-
-                    except IllegalMoveException:
-                        li.resign(game_id)
+                    move = session.play_move()
+                    if move is None:
                         stay_in_game = False
+                    else:
+                        engine.writer.chat(li, game_id, "player", json.dumps(move.info))
+                session.ping(upd)
 
-                wbtime = upd[wbtime_param(board)]
-                wbinc = upd[wbinc_param(board)]
-                terminate_time = msec(wbtime) + msec(wbinc) + seconds(60)
-                game.ping(abort_time, terminate_time)
-                prior_game = copy.deepcopy(game)
-
-            elif u_type == "ping" and should_exit_game(game, li):
+            elif u_type == "ping" and session.should_exit():
                 logger.info("should_exit_game returned true")
                 stay_in_game = False
         except (
@@ -179,14 +234,12 @@ def play_game(game_id: str, li: lichess.Lichess, config, username: str) -> None:
         ) as e:
             stopped = isinstance(e, StopIteration)
             stay_in_game = not stopped and (
-                move_attempted or game_is_active(li, game.id)
+                move_attempted or game_is_active(li, game_id)
             )
             logger.info(
                 f"exception caught: {e}, stopped = {stopped}, stay_in_game = {stay_in_game}"
             )
-    engine.remove_game(game_id)
-    tell_user_game_result(game, board)
-    logger.info(f"--- {game.url()} Game over")
+    session.end()
 
 
 def handle_challenge(
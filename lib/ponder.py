@@ -0,0 +1,102 @@
+"""Precomputing the bot's next move while the opponent is thinking."""
+
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from lib.prediction_cache import Prediction
+from lib.timer import Timer, seconds
+
+logger = logging.getLogger(__name__)
+
+
+class PonderJob:
+    def __init__(self) -> None:
+        self.stop = threading.Event()
+        self.future: Future | None = None
+
+
+class Ponderer:
+    """
+    Run `MimicBotCore.predict_replies` in the background after every bot move.
+
+    A game's job uses the game's KV cache, so `take` stops the job and waits
+    for it (at most one more single-token forward pass) before the game's
+    next prediction touches the cache.
+    """
+
+    def __init__(
+        self, core, top_k: int = 3, workers: int = 1, metrics_interval: float = 60
+    ) -> None:
+        """
+        :param core: The `MimicBotCore` that predicts the replies.
+        :param top_k: How many of the opponent's likeliest replies to prepare for.
+        :param workers: Games pondered at the same time.
+        :param metrics_interval: How often (in seconds) to log the hit rate; 0 disables logging.
+        """
+        self.core = core
+        self.top_k = top_k
+        self.metrics_interval = metrics_interval
+        self.metrics_timer = Timer(seconds(metrics_interval))
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="ponder")
+        self.jobs: dict[str, PonderJob] = {}
+        self.counts: Counter[str] = Counter()
+        self.lock = threading.Lock()
+
+    def start(self, game_id: str, board, inp, cache) -> None:
+        """Start pondering a game; `board` and `inp` include the bot's last move."""
+        self.finish(game_id)
+        job = PonderJob()
+        job.future = self.executor.submit(
+            self.core.predict_replies, board, inp, cache, self.top_k, job.stop
+        )
+        self.jobs[game_id] = job
+
+    def finish(self, game_id: str) -> dict[tuple, Prediction] | None:
+        """Stop pondering a game and get what was computed, or None if nothing was running."""
+        job = self.jobs.pop(game_id, None)
+        if job is None:
+            return None
+        job.stop.set()
+        if job.future.cancel():
+            return {}
+        try:
+            return job.future.result()
+        except Exception:
+            logger.exception(f"pondering failed for game {game_id}")
+            return {}
+
+    def take(self, game_id: str, key: tuple) -> Prediction | None:
+        """
+        Stop pondering a game and get the prediction for the position reached.
+
+        :param key: The tokens of the game after the opponent's move.
+        """
+        predictions = self.finish(game_id)
+        if predictions is None:
+            return None
+        prediction = predictions.get(key)
+        with self.lock:
+            self.counts["hits" if prediction is not None else "misses"] += 1
+            self.counts["forwards"] += len(predictions)
+            self.counts["wasted_forwards"] += len(predictions) - (prediction is not None)
+            log = self.metrics_interval and self.metrics_timer.is_expired()
+            if log:
+                self.metrics_timer.reset()
+        if log:
+            logger.info(f"ponder: {self.metrics()}")
+        return prediction
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            forwards = self.counts["forwards"]
+            return {
+                "top_k": self.top_k,
+                "hits": self.counts["hits"],
+                "misses": self.counts["misses"],
+                "hit_rate": self.counts["hits"] / lookups if lookups else 0,
+                "wasted_forwards": self.counts["wasted_forwards"],
+                "wasted_fraction": self.counts["wasted_forwards"] / forwards if forwards else 0,
+            }
@@ -0,0 +1,129 @@
+"""Move distributions and elo estimates cached by game prefix."""
+
+import json
+import threading
+from collections import Counter, OrderedDict
+
+import torch
+
+from lib.shared_store import SharedStore
+
+
+class Prediction:
+    """What `MimicBotCore.predict` needs from the model to pick a move."""
+
+    def __init__(self, probs: torch.Tensor, mvids: torch.Tensor, info: dict) -> None:
+        """
+        :param probs: The normalized top-n move distribution.
+        :param mvids: The vocabulary ids of the moves in `probs`.
+        :param info: The elo estimates returned with the move.
+        """
+        self.probs = probs
+        self.mvids = mvids
+        self.info = info
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {"probs": self.probs.tolist(), "mvids": self.mvids.tolist(), "info": self.info}
+        )
+
+    @classmethod
+    def loads(cls, value: str) -> "Prediction":
+        d = json.loads(value)
+        return cls(
+            torch.tensor(d["probs"], dtype=torch.float64),
+            torch.tensor(d["mvids"], dtype=torch.long),
+            d["info"],
+        )
+
+
+class PredictionCache:
+    """
+    An LRU cache of predictions keyed by the tokens of a game so far.
+
+    The model output for a token prefix never changes, and most games share
+    their opening plies, so early positions are mostly served from here.
+    Only the distribution is cached; every game still samples its own move.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 100000,
+        max_depth: int = 12,
+        shared_path: str | None = None,
+        namespace: str = "",
+    ) -> None:
+        """
+        :param max_entries: How many predictions to keep in this process (and in the shared store).
+        :param max_depth: Only positions up to this many plies into the game are cached.
+        :param shared_path: A sqlite file through which every worker on the host shares
+            predictions; each worker process opens its own connection to it.
+        :param namespace: Distinguishes the predictions of different models and settings.
+        """
+        self.max_entries = max_entries
+        self.max_depth = max_depth
+        self.namespace = namespace
+        self.entries: OrderedDict[tuple, Prediction] = OrderedDict()
+        self.counts: Counter[str] = Counter()
+        self.lock = threading.Lock()
+        self.shared = None
+        if shared_path is not None:
+            self.shared = SharedStore(shared_path, "predictions", max_entries)
+
+    def _key(self, inp: torch.Tensor) -> tuple | None:
+        # inp holds the start token followed by one token per ply
+        if inp.shape[1] - 1 > self.max_depth:
+            return None
+        return tuple(inp[0].tolist())
+
+    def _shared_key(self, key: tuple) -> str:
+        return self.namespace + ":" + ",".join(map(str, key))
+
+    def get(self, inp: torch.Tensor) -> Prediction | None:
+        key = self._key(inp)
+        if key is None:
+            return None
+        with self.lock:
+            prediction = self.entries.get(key)
+            if prediction is not None:
+                self.entries.move_to_end(key)
+                self.counts["hits"] += 1
+                return prediction
+        if self.shared is not None:
+            value = self.shared.get(self._shared_key(key))
+            if value is not None:
+                prediction = Prediction.loads(value)
+                self._insert(key, prediction)
+                with self.lock:
+                    self.counts["shared_hits"] += 1
+                return prediction
+        with self.lock:
+            self.counts["misses"] += 1
+        return None
+
+    def put(self, inp: torch.Tensor, prediction: Prediction) -> None:
+        key = self._key(inp)
+        if key is None:
+            return
+        self._insert(key, prediction)
+        if self.shared is not None:
+            self.shared.put(self._shared_key(key), prediction.dumps())
+
+    def _insert(self, key: tuple, prediction: Prediction) -> None:
+        with self.lock:
+            self.entries[key] = prediction
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = sum(self.counts.values())
+            hits = self.counts["hits"] + self.counts["shared_hits"]
+            return {
+                "entries": len(self.entries),
+                "hits": self.counts["hits"],
+                "shared_hits": self.counts["shared_hits"],
+                "misses": self.counts["misses"],
+                "hit_rate": hits / lookups if lookups else 0,
+            }
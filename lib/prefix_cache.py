@@ -0,0 +1,175 @@
+"""Attention state of common token prefixes, shared between games and analyses."""
+
+import threading
+from collections import Counter, OrderedDict
+
+import torch
+
+from lib.kvcache import KVCache
+
+
+class PrefixNode:
+    """One block of tokens and the keys/values every layer computed for them."""
+
+    def __init__(
+        self,
+        parent: "PrefixNode | None",
+        tokens: tuple,
+        keys: torch.Tensor | None,
+        values: torch.Tensor | None,
+    ) -> None:
+        self.parent = parent
+        self.tokens = tokens
+        # (n_layers, block_size, n_kv_heads, head_dim)
+        self.keys = keys
+        self.values = values
+        # elo head outputs of the block's positions, once an analysis has run it
+        self.elo: torch.Tensor | None = None
+        self.children: dict[tuple, PrefixNode] = {}
+        self.refs = 0
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = self.keys.nbytes + self.values.nbytes
+        return nbytes + (0 if self.elo is None else self.elo.nbytes)
+
+
+class PrefixKVCache:
+    """
+    A radix tree of KV-cache blocks keyed by token sequence.
+
+    Every edge of the tree is one block of `block_size` tokens, so the path to
+    a node spells out a block-aligned prefix of some game seen before. A game
+    or analysis copies the blocks of its longest matching prefix into its own
+    `KVCache` and only runs the model on the rest. Nodes are reference counted
+    while they are being copied from, and the least recently used leaves are
+    evicted to stay within the memory budget.
+    """
+
+    def __init__(self, memory_mb: float = 256, block_size: int = 16) -> None:
+        self.block_size = block_size
+        self.budget = int(memory_mb * 2**20)
+        self.nbytes = 0
+        self.root = PrefixNode(None, (), None, None)
+        self.lru: OrderedDict[int, PrefixNode] = OrderedDict()
+        self.counts: Counter[str] = Counter()
+        self.lock = threading.Lock()
+
+    def _blocks(self, tokens: list[int]):
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            yield start, tuple(tokens[start : start + self.block_size])
+
+    def _acquire(self, tokens: list[int], with_elo: bool) -> list[PrefixNode]:
+        with self.lock:
+            path = []
+            node = self.root
+            for _, block in self._blocks(tokens):
+                node = node.children.get(block)
+                if node is None or (with_elo and node.elo is None):
+                    break
+                path.append(node)
+            for node in path:
+                node.refs += 1
+                self.lru.move_to_end(id(node))
+            return path
+
+    def _release(self, path: list[PrefixNode]) -> None:
+        with self.lock:
+            for node in path:
+                node.refs -= 1
+
+    def extend(
+        self, cache: KVCache, inp: torch.Tensor, with_elo: bool = False, keep: int = 1
+    ) -> torch.Tensor | None:
+        """
+        Copy the cached blocks of the longest prefix of `inp` into `cache`.
+
+        :param with_elo: Only use blocks that carry elo outputs, and return the
+            elo outputs of every position copied, shaped (1, seqlen, 1, size).
+        :param keep: The number of last tokens always left for the model, so
+            that it returns outputs for each of them, e.g. the `last_n` elo
+            outputs of a move.
+        """
+        if cache.evicted:
+            return None
+        tokens = inp[0].tolist()
+        path = self._acquire(tokens[:-keep], with_elo)
+        with self.lock:
+            self.counts["hits" if path else "misses"] += 1
+        try:
+            matched = len(path) * self.block_size
+            if matched > cache.seqlen:
+                with torch.inference_mode():
+                    for i, node in enumerate(path):
+                        pos = i * self.block_size
+                        if pos + self.block_size <= cache.seqlen:
+                            continue
+                        for layer, keys, values in zip(cache.layers, node.keys, node.values):
+                            layer.cache_k[0, pos : pos + self.block_size] = keys
+                            layer.cache_v[0, pos : pos + self.block_size] = values
+                with self.lock:
+                    self.counts["reused_tokens"] += matched - cache.seqlen
+                cache.seqlen = matched
+            if with_elo and path:
+                return torch.cat([node.elo for node in path])[None]
+            return None
+        finally:
+            self._release(path)
+
+    def insert(self, cache: KVCache, inp: torch.Tensor, elo: torch.Tensor | None = None) -> None:
+        """
+        Add the full blocks of the `cache.seqlen` tokens of `inp` held in `cache`.
+
+        :param elo: The elo outputs of those positions, (1, seqlen, 1, size).
+        """
+        if cache.evicted:
+            # the cache no longer starts at the beginning of the game
+            return
+        tokens = inp[0, : cache.seqlen].tolist()
+        with self.lock, torch.inference_mode():
+            node = self.root
+            for start, block in self._blocks(tokens):
+                end = start + self.block_size
+                child = node.children.get(block)
+                if child is None:
+                    child = PrefixNode(
+                        node,
+                        block,
+                        torch.stack([layer.cache_k[0, start:end] for layer in cache.layers]),
+                        torch.stack([layer.cache_v[0, start:end] for layer in cache.layers]),
+                    )
+                    node.children[block] = child
+                    self.nbytes += child.nbytes
+                    self.counts["blocks"] += 1
+                if elo is not None and child.elo is None:
+                    child.elo = elo[0, start:end].clone()
+                    self.nbytes += child.elo.nbytes
+                self.lru[id(child)] = child
+                self.lru.move_to_end(id(child))
+                node = child
+            self._evict()
+
+    def _evict(self) -> None:
+        # only unreferenced leaves can go; removing one may expose its parent
+        while self.nbytes > self.budget:
+            for node in self.lru.values():
+                if node.refs == 0 and not node.children:
+                    break
+            else:
+                return
+            del self.lru[id(node)]
+            del node.parent.children[node.tokens]
+            self.nbytes -= node.nbytes
+            self.counts["blocks"] -= 1
+            self.counts["evictions"] += 1
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                "blocks": self.counts["blocks"],
+                "memory_mb": self.nbytes / 2**20,
+                "hits": self.counts["hits"],
+                "misses": self.counts["misses"],
+                "reused_tokens": self.counts["reused_tokens"],
+                "evictions": self.counts["evictions"],
+            }
@@ -0,0 +1,35 @@
+"""Reduced-precision inference for the CPU model."""
+
+import torch
+from torch import nn
+from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+PRECISIONS = ("fp32", "int8")
+
+# the Linear layers of these modules are quantized; the embedding and the
+# timecontrol preproc projection stay in fp32
+QUANTIZED_MODULES = ("Attention", "FeedForward", "MoveHead", "EloHead")
+
+
+def quantize(model: nn.Module, precision: str) -> nn.Module:
+    """
+    Convert a model to the given inference precision, in place.
+
+    :param precision: "fp32" leaves the model untouched; "int8" replaces the
+        Linear layers of `QUANTIZED_MODULES` with dynamically quantized ones
+        (int8 weights, activations quantized per batch at run time). The
+        quantized weights are private to each process, unlike the
+        memory-mapped fp32 checkpoint they are built from.
+    """
+    if precision == "fp32":
+        return model
+    if precision != "int8":
+        raise Exception(f"did not recognize precision {precision}")
+
+    qconfig_spec = {}
+    for parent_name, parent in model.named_modules():
+        if type(parent).__name__ in QUANTIZED_MODULES:
+            for name, child in parent.named_children():
+                if isinstance(child, nn.Linear):
+                    qconfig_spec[f"{parent_name}.{name}"] = default_dynamic_qconfig
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
@@ -0,0 +1,93 @@
+"""A lichess API rate limit shared by every worker process on the host."""
+
+import datetime
+import json
+import logging
+import time
+
+from lib.shared_store import SharedStore
+from lib.timer import sec_str, to_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    A token bucket for the lichess API, stored in a `SharedStore` so that every
+    process using the bot's token draws from the same bucket.
+
+    Moves may take any token; other requests leave `move_reserve` tokens in
+    the bucket for them, so a burst of chat messages or challenge handling
+    never delays a move. Callers wait exactly until their token is available
+    instead of a fixed delay. A 429 response blocks its endpoint for every
+    process until the delay lichess asks for has passed.
+    """
+
+    def __init__(
+        self,
+        path: str = "/tmp/mimicbot_rate_limit.db",
+        rate: float = 5,
+        burst: float = 10,
+        move_reserve: float = 4,
+    ) -> None:
+        """
+        :param path: The sqlite file shared by the processes.
+        :param rate: Tokens added to the bucket per second.
+        :param burst: The most tokens the bucket holds.
+        :param move_reserve: Tokens only moves may take.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.move_reserve = min(move_reserve, burst - 1)
+        self.store = SharedStore(path, "rate_limits")
+
+    def acquire(self, path_template: str, move: bool = False) -> None:
+        """Wait for a token to request `path_template` and take it."""
+        reserve = 0 if move else self.move_reserve
+        while True:
+            wait = self.store.update(
+                "bucket", lambda state: self._take(state, path_template, reserve)
+            )
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def block(self, path_template: str, delay: datetime.timedelta) -> None:
+        """Stop every process from requesting `path_template` for `delay`."""
+        logger.warning(
+            f"Endpoint {path_template} is rate limited. Waiting {sec_str(delay)} seconds until next request."
+        )
+        until = time.time() + to_seconds(delay)
+
+        def set_block(state):
+            state = self._load(state)
+            state["blocked"][path_template] = max(
+                until, state["blocked"].get(path_template, 0)
+            )
+            return json.dumps(state), None
+
+        self.store.update("bucket", set_block)
+
+    def _load(self, state: str | None) -> dict:
+        if state is None:
+            return {"tokens": self.burst, "time": time.time(), "blocked": {}}
+        return json.loads(state)
+
+    def _take(self, state: str | None, path_template: str, reserve: float):
+        # the wait (in seconds) until a token can be taken, or 0 if one was
+        state = self._load(state)
+        now = time.time()
+        state["tokens"] = min(
+            self.burst, state["tokens"] + (now - state["time"]) * self.rate
+        )
+        state["time"] = now
+        blocked = state["blocked"].get(path_template, 0) - now
+        if blocked > 0:
+            wait = blocked
+        elif state["tokens"] >= reserve + 1:
+            state["tokens"] -= 1
+            state["blocked"].pop(path_template, None)
+            wait = 0
+        else:
+            wait = (reserve + 1 - state["tokens"]) / self.rate
+        return json.dumps(state), wait
@@ -0,0 +1,146 @@
+"""Cross-game micro-batching of move predictions."""
+
+import logging
+import os
+import queue
+import threading
+from collections import Counter
+
+from lib.timer import Timer, msec, seconds, to_msec, to_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class PredictRequest:
+    """A pending call to `MimicBotCore.predict` waiting for its batch."""
+
+    def __init__(self, args: tuple) -> None:
+        self.args = args
+        self.latency = Timer()
+        self.done = threading.Event()
+        self.result = None
+
+
+class InferenceScheduler:
+    """
+    Gather `predict` calls from concurrently running games into batches.
+
+    Callers block in `predict` while a single worker thread collects requests
+    for up to `max_wait_ms` (or until `max_batch_size` are pending) and runs
+    them through `MimicBotCore.predict_batch` as one left-padded batch over
+    the games' KV caches.
+
+    Batches only form when several games of the same process predict at once,
+    i.e. with threaded workers or the asyncio game runtime. The worker thread
+    is started by the first `predict` of each process, since a thread started
+    before a fork does not exist in the child.
+    """
+
+    def __init__(
+        self,
+        core,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5,
+        max_queue_depth: int = 64,
+        metrics_interval: float = 60,
+    ) -> None:
+        """
+        :param core: The `MimicBotCore` that runs the batches.
+        :param max_batch_size: The largest number of games run in one forward pass.
+        :param max_wait_ms: How long the first request of a batch waits for company.
+        :param max_queue_depth: How many requests may be pending before `predict` blocks.
+        :param metrics_interval: How often (in seconds) to log the metrics; 0 disables logging.
+        """
+        self.core = core
+        self.max_batch_size = max_batch_size
+        self.max_wait = msec(max_wait_ms)
+        self.max_queue_depth = max_queue_depth
+        self.requests: queue.Queue[PredictRequest] = queue.Queue(maxsize=max_queue_depth)
+        self.metrics_interval = metrics_interval
+        self.metrics_timer = Timer(seconds(metrics_interval))
+        self.counts: Counter[str] = Counter()
+        self.latency_ms = 0.0
+        self.largest_batch = 0
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.worker = None
+        self.worker_pid = None
+
+    def _start_worker(self) -> None:
+        pid = os.getpid()
+        if self.worker_pid == pid:
+            return
+        with self.start_lock:
+            if self.worker_pid == pid:
+                return
+            # requests queued in a parent process are never answered here
+            self.requests = queue.Queue(maxsize=self.max_queue_depth)
+            self.worker = threading.Thread(
+                target=self._run, name="inference-scheduler", daemon=True
+            )
+            self.worker.start()
+            self.worker_pid = pid
+
+    def predict(self, *args):
+        """Queue a `MimicBotCore.predict` call and block until its batch has run."""
+        self._start_worker()
+        request = PredictRequest(args)
+        self.requests.put(request)
+        request.done.wait()
+        if isinstance(request.result, Exception):
+            raise request.result
+        return request.result
+
+    def metrics(self) -> dict:
+        """Get the scheduler settings and the batching statistics so far."""
+        with self.lock:
+            batches = self.counts["batches"]
+            requests = self.counts["requests"]
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": to_msec(self.max_wait),
+                "max_queue_depth": self.max_queue_depth,
+                "queue_depth": self.requests.qsize(),
+                "batches": batches,
+                "requests": requests,
+                "errors": self.counts["errors"],
+                "mean_batch_size": requests / batches if batches else 0,
+                "largest_batch": self.largest_batch,
+                "mean_latency_ms": self.latency_ms / requests if requests else 0,
+            }
+
+    def _collect(self) -> list[PredictRequest]:
+        batch = [self.requests.get()]
+        deadline = Timer(self.max_wait)
+        while len(batch) < self.max_batch_size:
+            try:
+                remaining = to_seconds(deadline.time_until_expiration())
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            try:
+                results = self.core.predict_batch([request.args for request in batch])
+            except Exception as e:
+                logger.exception("batched prediction failed")
+                results = [e] * len(batch)
+
+            with self.lock:
+                self.counts["batches"] += 1
+                self.counts["requests"] += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                for request, result in zip(batch, results):
+                    self.latency_ms += to_msec(request.latency.time_since_reset())
+                    self.counts["errors"] += isinstance(result, Exception)
+
+            for request, result in zip(batch, results):
+                request.result = result
+                request.done.set()
+
+            if self.metrics_interval and self.metrics_timer.is_expired():
+                logger.info(f"inference scheduler: {self.metrics()}")
+                self.metrics_timer.reset()
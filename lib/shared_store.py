@@ -0,0 +1,112 @@
+"""A small key/value table shared by every worker process on the host."""
+
+import os
+import sqlite3
+import threading
+
+
+class SharedStore:
+    """
+    String keys and values in a sqlite table.
+
+    Every process that opens the same file sees the same table, so Celery
+    workers can share results without a separate service. The oldest
+    entries are dropped once the table holds more than `max_entries`.
+
+    A sqlite connection must not be used across a fork, so each process
+    opens its own on first use.
+    """
+
+    def __init__(self, path: str, table: str, max_entries: int | None = None) -> None:
+        """
+        :param path: The sqlite database file; created if it does not exist.
+        :param table: The table holding this store's entries.
+        :param max_entries: How many entries to keep; None keeps every entry.
+        """
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.puts = 0
+        self.open_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_pid = None
+        # connections opened before a fork; closing one in the child could
+        # release the parent's locks on the file, so they are only kept
+        self.inherited: list[sqlite3.Connection] = []
+
+    def _connect(self) -> None:
+        pid = os.getpid()
+        if self.db_pid == pid:
+            return
+        with self.open_lock:
+            if self.db_pid == pid:
+                return
+            if self.db is not None:
+                self.inherited.append(self.db)
+            # the parent may have held the lock when it forked
+            self.lock = threading.Lock()
+            self.db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            with self.db:
+                # concurrent readers do not block the writer
+                self.db.execute("PRAGMA journal_mode=WAL")
+                # the entries can be rebuilt, so commits need not wait for
+                # fsync; with WAL the file still cannot be corrupted
+                self.db.execute("PRAGMA synchronous=NORMAL")
+                self.db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} "
+                    "(key TEXT PRIMARY KEY, value TEXT)"
+                )
+            self.db_pid = pid
+
+    def get(self, key: str) -> str | None:
+        self._connect()
+        with self.lock:
+            row = self.db.execute(
+                f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key: str, value: str) -> None:
+        self._connect()
+        with self.lock, self.db:
+            # a replaced key gets a new rowid, so rowids order entries by age
+            self.db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+                (key, value),
+            )
+            self.puts += 1
+            if self.max_entries is not None and self.puts % 1000 == 0:
+                self.db.execute(
+                    f"DELETE FROM {self.table} WHERE rowid <= "
+                    f"(SELECT MAX(rowid) FROM {self.table}) - ?",
+                    (self.max_entries,),
+                )
+
+    def update(self, key: str, update):
+        """
+        Replace the value of `key` atomically with respect to every process.
+
+        :param update: Called with the current value (None if the key is missing)
+            inside the transaction; returns the new value and a result.
+        :return: The result returned by `update`.
+        """
+        self._connect()
+        with self.lock:
+            # take the write lock before reading, so no other process can
+            # change the value in between
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                value, result = update(None if row is None else row[0])
+                self.db.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+                    (key, value),
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return result
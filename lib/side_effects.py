@@ -0,0 +1,198 @@
+"""Chat messages and database writes sent off the move's critical path."""
+
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from lib.timer import Timer, msec, to_seconds
+
+logger = logging.getLogger(__name__)
+
+# what happens to a new update when `max_pending` updates are already waiting
+DROP = "drop"  # the new update is discarded
+BLOCK = "block"  # the caller waits up to `block_timeout_ms`, then the update is discarded
+
+
+class SideEffectWriter:
+    """
+    Send lichess chat messages and Xata record updates from a background thread.
+
+    Updates are keyed by what they overwrite: a chat message by its game and
+    room, a record update by its table and id. An update to a key that is
+    still waiting replaces the waiting one (record fields are merged), so a
+    game that moves faster than the writer sends only its latest state.
+    Pending record updates are written in transactions of up to
+    `xata_batch_size` operations. The thread starts on the first update of
+    each process, so a writer created before a fork also works in the child.
+    """
+
+    def __init__(
+        self,
+        xata,
+        max_pending: int = 1024,
+        xata_batch_size: int = 50,
+        chat_policy: str = DROP,
+        record_policy: str = BLOCK,
+        block_timeout_ms: float = 1000,
+    ) -> None:
+        """
+        :param xata: The `XataClient` the record updates are written with.
+        :param max_pending: The number of keys that may wait to be written.
+        :param chat_policy: `DROP` or `BLOCK`, for chat messages once `max_pending` is reached.
+        :param record_policy: `DROP` or `BLOCK`, for record updates once `max_pending` is reached.
+        :param block_timeout_ms: The longest a `BLOCK` update waits for room.
+        """
+        self.xata = xata
+        self.max_pending = max_pending
+        self.xata_batch_size = xata_batch_size
+        self.policies = {"chat": chat_policy, "record": record_policy}
+        self.block_timeout = msec(block_timeout_ms)
+        # key -> (kind, payload), oldest first
+        self.pending: OrderedDict[tuple, tuple] = OrderedDict()
+        self.counts: Counter[str] = Counter()
+        # keys taken by the thread and not written yet
+        self.in_flight: list[tuple] = []
+        self.cond = threading.Condition()
+        self.start_lock = threading.Lock()
+        self.worker = None
+        self.worker_pid = None
+
+    def chat(self, li, game_id: str, room: str, text: str) -> None:
+        """Queue `li.chat(game_id, room, text)`."""
+        self._submit(("chat", game_id, room), "chat", (li, text))
+
+    def update_record(self, table: str, record_id: str, fields: dict) -> None:
+        """Queue `xata.records().update(table, record_id, fields)`."""
+        self._submit(("record", table, record_id), "record", fields)
+
+    def flush(self, game_id: str | None = None, timeout_ms: float = 10000) -> bool:
+        """
+        Wait until the updates queued so far are written.
+
+        :param game_id: Only wait for this game's chat messages and record.
+        :return: False if some were still waiting after `timeout_ms`.
+        """
+
+        def written():
+            keys = [*self.pending, *self.in_flight]
+            return not any(game_id is None or game_id in key for key in keys)
+
+        with self.cond:
+            return self.cond.wait_for(written, to_seconds(msec(timeout_ms)))
+
+    def metrics(self) -> dict:
+        with self.cond:
+            return {"pending": len(self.pending), **self.counts}
+
+    def _start_worker(self) -> None:
+        pid = os.getpid()
+        if self.worker_pid == pid:
+            return
+        with self.start_lock:
+            if self.worker_pid == pid:
+                return
+            # updates queued in a parent process are written by the parent
+            self.pending = OrderedDict()
+            self.in_flight = []
+            self.cond = threading.Condition()
+            self.worker = threading.Thread(
+                target=self._run, name="side-effect-writer", daemon=True
+            )
+            self.worker.start()
+            self.worker_pid = pid
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self.cond:
+            self.counts[name] += n
+
+    def _submit(self, key: tuple, kind: str, payload) -> None:
+        self._start_worker()
+        with self.cond:
+            self.counts[f"{kind}_submitted"] += 1
+            if key in self.pending:
+                self.counts[f"{kind}_coalesced"] += 1
+                if kind == "record":
+                    payload = {**self.pending[key][1], **payload}
+                self.pending[key] = (kind, payload)
+                return
+            if len(self.pending) >= self.max_pending:
+                if self.policies[kind] == BLOCK:
+                    deadline = Timer(self.block_timeout)
+                    self.cond.wait_for(
+                        lambda: len(self.pending) < self.max_pending,
+                        to_seconds(deadline.time_until_expiration()),
+                    )
+                if len(self.pending) >= self.max_pending:
+                    self.counts[f"{kind}_dropped"] += 1
+                    logger.warning(f"side effect queue full, dropped {key}")
+                    return
+            self.pending[key] = (kind, payload)
+            self.cond.notify_all()
+
+    def _take(self) -> list[tuple]:
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.pending) > 0)
+            items = [(key, *value) for key, value in self.pending.items()]
+            self.in_flight = list(self.pending)
+            self.pending.clear()
+            # wake callers blocked on a full queue
+            self.cond.notify_all()
+            return items
+
+    def _run(self) -> None:
+        while True:
+            items = self._take()
+            records = []
+            for key, kind, payload in items:
+                if kind == "chat":
+                    _, game_id, room = key
+                    li, text = payload
+                    self._send_chat(li, game_id, room, text)
+                else:
+                    _, table, record_id = key
+                    records.append(
+                        {"update": {"table": table, "id": record_id, "fields": payload}}
+                    )
+            for i in range(0, len(records), self.xata_batch_size):
+                self._write_records(records[i : i + self.xata_batch_size])
+            with self.cond:
+                self.in_flight = []
+                # wake callers of flush
+                self.cond.notify_all()
+
+    def _send_chat(self, li, game_id: str, room: str, text: str) -> None:
+        try:
+            li.chat(game_id, room, text)
+            self._count("chat_sent")
+        except Exception:
+            self._count("chat_errors")
+            logger.exception(f"chat to {game_id} failed")
+
+    def _write_records(self, operations: list[dict]) -> None:
+        if len(operations) == 1:
+            self._write_record(operations[0]["update"])
+            return
+        try:
+            self.xata.records().transaction({"operations": operations})
+            self._count("records_written", len(operations))
+            self._count("transactions")
+            return
+        except Exception:
+            self._count("transaction_errors")
+            logger.exception(
+                f"writing {len(operations)} records failed, retrying one at a time"
+            )
+        # a transaction is all or nothing, so one bad record would drop the
+        # updates of every other game in it
+        for operation in operations:
+            self._write_record(operation["update"])
+
+    def _write_record(self, update: dict) -> None:
+        try:
+            self.xata.records().update(update["table"], update["id"], update["fields"])
+            self._count("records_written")
+            self._count("transactions")
+        except Exception:
+            self._count("record_errors")
+            logger.exception(f"writing record {update['id']} failed")
@@ -2,17 +2,23 @@ import logging
 import os
 import pathlib
 import io
+import json
+import threading
 from typing import Any
 
 import yaml
 from celery import shared_task, Task
-from flask import request, Flask
+from flask import request, Flask, Response, stream_with_context
 from flask_cors import CORS
 
 from lib import lichess
+from lib.game_runtime import AsyncGameRuntime
+from lib.ongoing_games import OngoingGames
+from lib.rate_limit import RateLimiter
 from lib.models import get_config
 from lib.models.latest import MODEL_ID
-from lib.play_game import handle_challenge, play_game, analyze_pgn
+from lib.play_game import (
+    handle_challenge, play_game, analyze_pgn, analyze_pgns, engine)
 from flask_factory import celery_init_app
 import requests
 
@@ -50,14 +56,51 @@ __version__ = versioning_info["lichess_bot_version"]
 
 config = get_config(os.path.join(dn, "config.yml"))
 logging_level = logging.INFO
+
+game_runtime_name = getattr(config, "game_runtime", "celery")
+# the pool of `celery worker`; do not override it with --pool on the command line
+celery_app.conf.worker_pool = getattr(config, "celery_pool", "prefork")
+if (
+    engine.scheduler is not None
+    and game_runtime_name == "celery"
+    and celery_app.conf.worker_pool != "threads"
+):
+    # a prefork worker plays one game at a time, so its moves never batch and
+    # only pay max_wait_ms
+    raise Exception(
+        "inference batching needs game_runtime: asyncio or celery_pool: threads"
+    )
 max_retries = config.engine.online_moves.max_retries
 
+# shared by the web process and every celery worker
+rate_limiter = RateLimiter(**config.__dict__.get("rate_limits", {}))
 li = lichess.Lichess(config.token, config.url,
-                     __version__, logging_level, max_retries)
+                     __version__, logging_level, max_retries, rate_limiter)
 user_profile = li.get_profile()
+li.ongoing_games = OngoingGames(
+    li.fetch_ongoing_games, **config.__dict__.get("ongoing_games", {}))
 
 active_games = set()
 
+game_runtime = None
+game_runtime_lock = threading.Lock()
+
+
+def get_game_runtime() -> AsyncGameRuntime:
+    # started on the first game, so celery workers importing this module
+    # never start one
+    global game_runtime
+    with game_runtime_lock:
+        if game_runtime is None:
+            game_runtime = AsyncGameRuntime(
+                li,
+                config,
+                user_profile["username"],
+                getattr(config, "inference_workers", None),
+                on_finish=active_games.discard,
+            )
+        return game_runtime
+
 
 class CallbackTask(Task):
     def on_success(
@@ -91,6 +134,15 @@ def say_hello():
     return f"MimicBot model {MODEL_ID} serving from {vm_hostname()}"
 
 
+@app.get("/metrics")
+def metrics():
+    # the counters of this process; celery workers log their own
+    metrics = engine.metrics()
+    if game_runtime is not None:
+        metrics["game_runtime"] = game_runtime.metrics()
+    return metrics
+
+
 @app.get('/isAvailable')
 def isAvailable():
     return {'available': len(li.get_ongoing_games()) < config.challenge.concurrency}
@@ -119,7 +171,10 @@ def gameStart(gameId: str):
         return {"gameStart": {"accepted": False, "decline_reason": gameId + " exists"}}
     else:
         active_games.add(gameId)
-        handle_play_game.delay(gameId)
+        if game_runtime_name == "asyncio":
+            get_game_runtime().start_game(gameId)
+        else:
+            handle_play_game.delay(gameId)
         return {"gameStart": {"accepted": True}}
 
 
@@ -135,5 +190,14 @@ def analyzePgn():
     return analyze_pgn(io.StringIO(msg))
 
 
+@app.post("/analyzePgns")
+def analyzePgns():
+    # body is a multi-game PGN or a list of PGNs; streams one NDJSON line per game
+    msg = request.json
+    pgns = [io.StringIO(pgn) for pgn in (msg if isinstance(msg, list) else [msg])]
+    lines = (json.dumps(result) + "\n" for result in analyze_pgns(pgns))
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
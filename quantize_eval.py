@@ -0,0 +1,85 @@
+import argparse
+import time
+
+import chess.pgn
+import numpy as np
+import torch
+
+from lib.mimic import MimicBotCore, tokenize_game
+from lib.quantize import PRECISIONS
+
+parser = argparse.ArgumentParser(
+    description="Compare a reduced-precision model against fp32 on sample games",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("pgn", help="PGN file with sample games")
+parser.add_argument("--precision", default="int8",
+                    choices=[p for p in PRECISIONS if p != "fp32"])
+parser.add_argument("--num_games", type=int, default=100,
+                    help="number of games read from the PGN")
+
+
+def read_games(fn, num_games):
+    games = []
+    with open(fn) as f:
+        while len(games) < num_games:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                break
+            if "FEN" not in game.headers:
+                games.append(game)
+    return games
+
+
+def run(core, inp):
+    start = time.perf_counter()
+    mv_pred, elo_pred = core.model(
+        inp, move_head=(*core.move_head, None), elo_head=core.elo_head)
+    elapsed = time.perf_counter() - start
+    # the color that plays after each position, as in MimicBotCore.predict
+    colors = (torch.arange(inp.shape[1]) + 1) % 2
+    logits = mv_pred[0, torch.arange(inp.shape[1]), colors]
+    ms, ss = core.create_elo_analysis(elo_pred)
+    return logits.log_softmax(dim=-1), ms, ss, elapsed
+
+
+def main():
+    args = parser.parse_args()
+    games = read_games(args.pgn, args.num_games)
+    reference = MimicBotCore(precision="fp32")
+    candidate = MimicBotCore(precision=args.precision)
+    max_len = 2 * reference.model_args.max_seq_len
+
+    kls, agree, dms, dss = [], [], [], []
+    times = {"fp32": 0.0, args.precision: 0.0}
+    for game in games:
+        _, inp = tokenize_game(game)
+        inp = inp[:, :max_len]
+        logp, ms, ss, t_ref = run(reference, inp)
+        logq, qms, qss, t_cand = run(candidate, inp)
+        times["fp32"] += t_ref
+        times[args.precision] += t_cand
+
+        kls.append((logp.exp() * (logp - logq)).sum(dim=-1))
+        agree.append(logp.argmax(dim=-1) == logq.argmax(dim=-1))
+        # the first two entries are the fixed prior, not model outputs
+        dms.append((qms - ms)[2:].abs())
+        dss.append((qss.sqrt() - ss.sqrt())[2:].abs())
+
+    kl = torch.cat(kls).numpy()
+    agree = torch.cat(agree).float().numpy()
+    dm = torch.cat(dms).numpy()
+    ds = torch.cat(dss).numpy()
+    print(f"{len(games)} games, {len(kl)} positions, fp32 vs {args.precision}")
+    print(f"move KL divergence: mean {kl.mean():.5f}  "
+          f"p99 {np.percentile(kl, 99):.5f}  max {kl.max():.5f}")
+    print(f"top-1 move agreement: {100 * agree.mean():.2f}%")
+    print(f"elo mean delta: mean {dm.mean():.2f}  "
+          f"p99 {np.percentile(dm, 99):.2f}  max {dm.max():.2f}")
+    print(f"elo std delta: mean {ds.mean():.2f}  "
+          f"p99 {np.percentile(ds, 99):.2f}  max {ds.max():.2f}")
+    for name, t in times.items():
+        print(f"{name} forward time: {t:.2f}s")
+
+
+if __name__ == "__main__":
+    main()